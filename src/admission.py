@@ -0,0 +1,107 @@
+# Standard library imports
+import math
+import time
+import threading
+from collections import Counter
+from typing import Optional
+
+# Local application imports
+import common
+import metrics
+
+# Constants (costs are in agent-days, i.e. days in the range x agents selected)
+CHEAP_REPORT_COST = 100  # Reports this size or smaller are never held back (e.g. a week for 14 agents)
+COST_BUDGET = 1000  # Agent-days of large reports allowed to run at once in each web process (so x the gunicorn workers in total)
+MAX_LARGE_PER_USER = 1  # Large reports each user can have running (or waiting) at once in each web process
+MAX_QUEUED = 4  # Large reports allowed to wait for a slot in each web process before new ones are turned away
+QUEUE_TIMEOUT = 5  # Seconds a large report waits for a slot before giving up (a waiting request holds a sync worker, so keep this well under gunicorn's 30s timeout)
+RETRY_AFTER = 30  # Seconds we ask a turned away browser to wait before trying again
+
+# Set up a global custom logger object for this script
+logger = common.setup_custom_logger("admission")
+
+
+def estimate_cost(start_date_time, end_date_time, agents: list) -> int:
+    """Estimate the work in a report as the number of days in the range times the number of agents"""
+    days = max(1, math.ceil((end_date_time - start_date_time).total_seconds() / 86400))
+    return days * len(agents)
+
+
+class AdmissionController:
+    """Decides whether a report can start now, has to wait, or should be turned away.
+       Cheap reports always go straight through. Large ones share a budget of agent-days, each user can only
+       run one at a time, and only a few can wait for room in the budget, so a burst of big requests can't tie up
+       every worker while small ones keep flowing.
+       The counters live in memory, so every limit is per web process: with `gunicorn --workers 4` up to 4 x COST_BUDGET
+       agent-days can run at once, and a user can have one large report running in each worker.
+    """
+
+    def __init__(self, cheap_cost: int = CHEAP_REPORT_COST, cost_budget: int = COST_BUDGET, max_per_user: int = MAX_LARGE_PER_USER,
+                 max_queued: int = MAX_QUEUED, queue_timeout: float = QUEUE_TIMEOUT):
+        self.cheap_cost = cheap_cost
+        self.cost_budget = cost_budget
+        self.max_per_user = max_per_user
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.condition = threading.Condition()
+        self.cost_in_flight = 0
+        self.queued = 0
+        self.users = Counter()  # user ID -> large reports running or waiting
+
+    def fits(self, cost: int) -> bool:
+        # A single report bigger than the whole budget can still run, just on its own
+        return self.cost_in_flight == 0 or self.cost_in_flight + cost <= self.cost_budget
+
+    def acquire(self, user_id: str, cost: int) -> Optional[str]:
+        """Wait (up to queue_timeout) for room to run a report. Returns None if admitted, otherwise the reason it was refused.
+           Every admitted report must be followed by release() with the same arguments.
+        """
+
+        metrics.observe_rows("admission.cost", cost)
+        if cost <= self.cheap_cost:
+            return None
+
+        with self.condition:
+            if self.users[user_id] >= self.max_per_user:
+                return "You already have a large report running. Please wait for it to finish."
+
+            if not self.fits(cost):
+                if self.queued >= self.max_queued:
+                    logger.warning(f"Turning away a {cost} agent-day report: {self.queued} large reports already waiting")
+                    return "The tracker is busy with other large reports."
+
+                # Wait our turn (holding the user's slot so they can't queue a second one)
+                self.queued += 1
+                self.users[user_id] += 1
+                start = time.perf_counter()
+                try:
+                    admitted = self.condition.wait_for(lambda: self.fits(cost), timeout=self.queue_timeout)
+                finally:
+                    self.queued -= 1
+                metrics.stage_duration.observe("admission.wait", time.perf_counter() - start)
+
+                if not admitted:
+                    self.users[user_id] -= 1
+                    logger.warning(f"A {cost} agent-day report gave up waiting after {self.queue_timeout}s")
+                    return "The tracker is busy with other large reports."
+            else:
+                self.users[user_id] += 1
+
+            self.cost_in_flight += cost
+            return None
+
+    def release(self, user_id: str, cost: int) -> None:
+        """Hand back an admitted report's share of the budget and wake anyone waiting"""
+        if cost <= self.cheap_cost:
+            return
+
+        with self.condition:
+            self.cost_in_flight -= cost
+            self.users[user_id] -= 1
+            if self.users[user_id] <= 0:
+                del self.users[user_id]
+            self.condition.notify_all()
+
+
+# One controller per process
+controller = AdmissionController()
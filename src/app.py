@@ -1,40 +1,155 @@
 # Standard library imports
 import os
-import secrets
+import hmac
+import queue
+import hashlib
+import functools
 import datetime as dt
 import sqlite3
 
 # Third-party imports
 from flask import (
     Flask, request, send_file, render_template, jsonify,
-    send_from_directory, session, after_this_request, redirect, url_for
+    send_from_directory, session, after_this_request, redirect, url_for,
+    Response
 )
 from apscheduler.schedulers.background import BackgroundScheduler
+from werkzeug.security import safe_join
 
 # Local application imports
+import live
 import common
+import admission
+import metrics
+import report_store
+import schema
 import utilities
+import robot_usage_tracker
 
 # Flask app setup
 app = Flask(__name__)
 
 # Secret key for session management
-app.secret_key = secrets.token_hex(16)  
+# Note this has to be the same across restarts and worker processes, otherwise existing session cookies stop validating
+app.secret_key = common.load_secret_key()
+
+# Keep the session (and so the user ID) across browser restarts
+app.config['PERMANENT_SESSION_LIFETIME'] = common.SESSION_LIFETIME
 
 # Set up a global custom logger object for this script
 logger = common.setup_custom_logger("app.py")
 
+# Create any missing tables and run the quick migrations before we serve requests (run schema.py for the AgentUsage one)
+schema.ensure_schema()
+
+# Endpoints that don't need a user session (e.g. scraped by monitoring)
+SESSIONLESS_ENDPOINTS = {'metrics_endpoint', 'slow_queries', 'webhook_events', 'live_stream', 'rollup_api'}
+
+# Token for the admin endpoints. If unset, they're switched off (behind a proxy every request looks local).
+ADMIN_TOKEN = os.environ.get('ROBOT_TRACKER_ADMIN_TOKEN')
+
+# Shared secret used to sign pushed availability events. The webhook is disabled if unset.
+WEBHOOK_SECRET = os.environ.get('ROBOT_TRACKER_WEBHOOK_SECRET')
+MAX_EVENTS_PER_REQUEST = 1000
+
+# Seconds between keep-alive comments on the live stream (stops proxies closing idle connections)
+LIVE_HEARTBEAT = 15
+
+# *** ADMISSION CONTROL ***
+def report_cost() -> int:
+    """Estimate the cost of a /filter request. Team summaries run in SQL and pre-warmed reports come from the cache, so they're free."""
+    
+    if request.form.get('mode') == 'teams':
+        return 0
+    
+    start_date_time, end_date_time = common.create_datetime_object(request)
+    agents = request.form.getlist('agent')
+    
+    r = common.redis_connect()
+    if r and common.redis_pull_report(r, common.report_cache_key(start_date_time, end_date_time, agents)):
+        return 0
+    
+    return admission.estimate_cost(start_date_time, end_date_time, agents)
+
+def admission_controlled(view):
+    """Hold large reports back until there's room for them, or turn them away with a 429 if too many are already waiting"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        user_id = session.get('id')
+        cost = report_cost()
+        
+        refused = admission.controller.acquire(user_id, cost)
+        if refused:
+            return render_template('busy.html', message=refused, retry_after=admission.RETRY_AFTER), 429, {'Retry-After': str(admission.RETRY_AFTER)}
+        
+        try:
+            return view(*args, **kwargs)
+        finally:
+            admission.controller.release(user_id, cost)
+    return wrapper
+
+# *** HTTP CACHING ***
+# Rendered agent checkbox tree for the homepage, keyed by config version
+agent_tree_cache = {}
+
+def render_agent_tree() -> str:
+    """Render the homepage's team/agent checkboxes once per config version rather than on every request"""
+    
+    version = common.config_version()
+    agent_tree = agent_tree_cache.get(version)
+    if agent_tree is None:
+        logger.info(f"Rendering agent tree for config version {version}")
+        agent_tree = render_template('agent_tree.html', teams_hierarchy=common.teams_hierarchy)
+        agent_tree_cache.clear()
+        agent_tree_cache[version] = agent_tree
+    
+    return agent_tree
+
+@app.template_filter('chart_url')
+def chart_url(chart_path: str) -> str:
+    """Versioned URL for a generated chart: it changes whenever the image does, so browsers can keep each version for as long as they like"""
+    chart_path = os.path.relpath(chart_path, common.CHART_FOLDER).replace(os.sep, '/')
+    return url_for('chart', chart_path=chart_path, v=common.chart_etag(os.path.join(common.CHART_FOLDER, chart_path))[:12])
+
+def send_chart(chart_path: str) -> Response:
+    """Send a chart with a strong ETag and Last-Modified, answering revalidations with a 304.
+       Charts of finished periods can be kept for a year, the rest have to be revalidated each time.
+    """
+    
+    closed = common.chart_period_closed(chart_path)
+    response = send_file(
+        chart_path,
+        mimetype='image/png',
+        etag=common.chart_etag(chart_path),
+        conditional=True,
+        max_age=common.CHART_MAX_AGE if closed else 0,
+    )
+    
+    # Reports are per user, so only the browser should cache them (not shared proxies)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    if closed:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    
+    return response
+
 # *** ROUTES ***  
 @app.before_request
 def before_request():
     """Set the user's session ID if it doesn't exist"""
 
+    if request.endpoint in SESSIONLESS_ENDPOINTS:
+        return
+
     if 'id' not in session:
         # Logging
         logger.info("User ID not found in session object")
         
         # Set the userID
-        session['id'] = common.generate_user_id(app)
+        session.permanent = True
+        session['id'] = common.generate_user_id()
         
         # Logging
         logger.info(f"User ID set to {session['id']}")
@@ -43,13 +158,32 @@ def before_request():
         logger.info(f"User ID found in session object: {session['id']}")
         pass
 
+@app.after_request
+def after_request(response):
+    """Every few seconds, add this worker's metrics to the shared web snapshot so /metrics counts every worker"""
+    
+    try:
+        metrics.save_snapshot_periodically("web")
+    except OSError as e:
+        logger.error(f"Could not save the metrics snapshot: {e}")
+    
+    return response
+
 @app.route('/', methods=['GET'])
 def homepage():
     """ Render the homepage.html template to the browser with specific data """
     
-    return render_template('homepage.html', teams_hierarchy=common.teams_hierarchy, valid_domains=common.valid_domains, user_id=session['id'])
+    response = Response(render_template('homepage.html', agent_tree=render_agent_tree(), valid_domains=common.valid_domains, user_id=session['id']))
+    
+    # Let the browser revalidate its copy (304 if nothing has changed) instead of downloading the page again
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route(f'/filter_<user_id>', methods=['POST'])
+@metrics.timed("filter.total")
+@admission_controlled
 def filter_data(user_id):
     """ Filter the data based on the form inputs and return the results as a JSON object """
  
@@ -61,49 +195,156 @@ def filter_data(user_id):
     
     # Update the database if the user has opted in to receive emails 
     utilities.email_opt_in(request, agents)
+    
+    # Team summary mode: totals per manager's team computed in the database, no raw events or charts
+    if request.form.get('mode') == 'teams':
+        managers = [manager for manager, team in common.teams_hierarchy.items() if set(team) & set(agents)]
+        with metrics.time_stage("filter.rollup"):
+            rollup = common.team_rollup(start_date_time, end_date_time, managers)
+        metrics.observe_rows("filter.rollup", len(rollup))
+        return render_template('filter.html', rollup=rollup)
+
+    # Serve the report straight from the cache if the scheduler has pre-warmed this range and agent set (see utilities.prewarm_reports)
+    r = common.redis_connect()
+    report = common.redis_pull_report(r, common.report_cache_key(start_date_time, end_date_time, agents)) if r else None
+    if report:
+        logger.info("Serving pre-warmed report from cache")
+        common.redis_add_to_cache(r, session.get('id'), report["csv_file_path"], agents)
+        session['recurrence'] = report["recurrence"]
+        periods = common.summary_periods(report["chart_paths"], report["csv_file_path"], report["recurrence"])
+        return render_template('filter.html', chart_paths=report["chart_paths"], periods=periods)
 
-    # Concatenate the start and end date time objects with the agents list to create a list of query parameters
-    query_paramaters = [start_date_time, end_date_time] + agents
+    # Concatenate the start and end times (as epoch seconds) with the agents list to create a list of query parameters
+    query_paramaters = [common.to_epoch(start_date_time), common.to_epoch(end_date_time)] + agents
     
     # Build the SQL query
-    placeholders = ','.join(['?'] * len(agents))
-    sql_query = f"SELECT * FROM AgentUsage WHERE ACTUAL_DATE_TIME BETWEEN ? AND ? AND NAME IN ({placeholders})"
+    sql_query = common.usage_query(agents)
     
     
     # Query the database
-    results = common.connect_to_database(sql_query, query_paramaters)
+    with metrics.time_stage("filter.query"):
+        results = common.query_reports(sql_query, query_paramaters, common.to_epoch(end_date_time))
+    metrics.observe_rows("filter.query", len(results or []))
     
     # Map the user's session ID to the csv_file_path and filename so we can access it later
     # Firstly we need to get the user's session ID from the session object
     user_id = session.get('id')
     
     # Create csv and save in user specific temp folder
-    csv_file_path, filename, recurrence = common.create_csv(results, user_id)
+    with metrics.time_stage("filter.create_csv"):
+        csv_file_path, filename, recurrence = common.create_csv(results, user_id)
+    metrics.observe_bytes("filter.create_csv", metrics.file_sizes([csv_file_path]))
+    session['recurrence'] = recurrence
     
     # Connect to the Redis server
-    r = common.redis_connect()
+    with metrics.time_stage("filter.redis"):
+        r = common.redis_connect()
+        
+        if r:
+            # Add the results to the cache against the user's session ID, along with the agents for charting single
+            # periods of a summarized report on demand (see chart_detail)
+            common.redis_add_to_cache(r, user_id, csv_file_path, agents)
     
     if not r:
         # Return error page if the Redis cache isn't available
         logger.error("Redis cache not available")
         return render_template("error.html")
-    else:
-        # Add the results to the cache against the user's session ID
-        common.redis_add_to_cache(r, user_id, csv_file_path)
     
     # Create a graph and save it as an image in the user's temp folder
-    chart_paths = common.create_graph(csv_file_path, agents, recurrence)
+    with metrics.time_stage("filter.create_graph"):
+        chart_paths = common.create_graph(csv_file_path, agents, recurrence)
+    metrics.observe_bytes("filter.create_graph", metrics.file_sizes(chart_paths))
+    
+    # Long ranges get a single summary chart, with each period's chart created only if it's asked for
+    periods = common.summary_periods(chart_paths, csv_file_path, recurrence)
     
     # Return the chart data and CSV download URL as JSON
-    return render_template('filter.html', chart_paths=chart_paths)
+    return render_template('filter.html', chart_paths=chart_paths, periods=periods)
+
+@app.route('/chart_detail/<period>', methods=['GET'])
+def chart_detail(period):
+    """Create (the first time it's asked for) and redirect to the chart for one period of the user's last summarized report"""
+    
+    r = common.redis_connect()
+    if not r:
+        logger.error("Redis cache not available")
+        return render_template("error.html")
+    
+    csv_file_path = common.redis_pull_from_cache(r, session.get('id'))
+    agents = common.redis_pull_agents(r, session.get('id'))
+    if not csv_file_path or agents is None:
+        return "Report has expired, please submit the filter again", 404
+    csv_file_path = csv_file_path.decode('utf-8')
+    recurrence = session.get('recurrence', 'daily')
+    
+    # Only periods that are actually in the report (this also keeps the file name below safe)
+    if period not in common.chart_periods(csv_file_path, recurrence):
+        return "Period not found in this report", 404
+    
+    # Reuse the chart if it was already created for this report (i.e. it's newer than the CSV)
+    graph_path = os.path.join(os.path.dirname(csv_file_path), f"graph_{period}.png")
+    if not os.path.exists(graph_path) or os.path.getmtime(graph_path) < os.path.getmtime(csv_file_path):
+        with metrics.time_stage("filter.chart_detail"):
+            common.create_graph(csv_file_path, agents, recurrence, only_period=period)
+    
+    # This URL shows a different image for every report, so send the browser to the chart's versioned URL (see chart_url)
+    # rather than letting it cache the image under this one
+    return redirect(chart_url(graph_path))
+
+@app.route('/charts/<path:chart_path>', methods=['GET'])
+def chart(chart_path):
+    """Send a generated chart from the temp folder (see chart_url). The ?v= version in the URL is only there to bust caches."""
+    
+    graph_path = safe_join(common.CHART_FOLDER, chart_path)
+    if not graph_path or not graph_path.endswith('.png') or not os.path.isfile(graph_path):
+        return "Chart not found", 404
+    
+    return send_chart(graph_path)
+
+@app.route('/api/rollup', methods=['GET'])
+def rollup_api():
+    """Return team and org totals as JSON, e.g. /api/rollup?start=2025-02-17 03:00&end=2025-02-22 02:30&manager=Manager1
+       start/end are 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM', manager can be repeated (defaults to every team)
+       and period is daily or weekly (defaults to weekly for ranges of 14 days or more).
+    """
+    
+    try:
+        start_date_time = dt.datetime.fromisoformat(request.args['start'])
+        end_date_time = dt.datetime.fromisoformat(request.args['end'])
+    except (KeyError, ValueError):
+        return jsonify({"error": "start and end are required, as YYYY-MM-DD or YYYY-MM-DD HH:MM"}), 400
+    
+    recurrence = request.args.get('period')
+    if recurrence not in (None, 'daily', 'weekly'):
+        return jsonify({"error": "period must be daily or weekly"}), 400
+    
+    managers = request.args.getlist('manager')
+    unknown_managers = set(managers) - set(common.teams_hierarchy)
+    if unknown_managers:
+        return jsonify({"error": f"Unknown manager(s): {', '.join(sorted(unknown_managers))}"}), 400
+    
+    rollup = common.team_rollup(start_date_time, end_date_time, managers, recurrence)
+    
+    return jsonify({
+        "start": start_date_time.isoformat(sep=' '),
+        "end": end_date_time.isoformat(sep=' '),
+        "period": recurrence or common.rollup_recurrence(start_date_time, end_date_time),
+        "rollup": rollup,
+    })
 
 @app.route('/download_csv', methods=['GET'])
 def download_csv():
-    """Send the generated CSV file for the user's query results."""
+    """Send the generated CSV file for the user's query results.
+       ?format=parquet or ?format=arrow sends the same data as a typed columnar file instead.
+    """
     
     # Get the user's session ID from the session object
     user_id = session.get('id')
     
+    export_format = request.args.get('format', 'csv')
+    if export_format not in common.EXPORT_FORMATS:
+        return f"Format must be one of {', '.join(common.EXPORT_FORMATS)}", 400
+    
     try:
         # Connect to the Redis server
         r = common.redis_connect()
@@ -112,12 +353,18 @@ def download_csv():
             # Identify the user's csv file path
             csv_file_path = common.redis_pull_from_cache(r, user_id).decode('utf-8')
             
+            # Convert it if another format was asked for
+            with metrics.time_stage(f"download.{export_format}"):
+                export_path = common.create_export(csv_file_path, export_format)
+            if not export_path:
+                return f"{export_format.title()} export isn't available on this server (pyarrow is not installed)", 501
+            
             # Get the filename from the path
-            filename = os.path.basename(csv_file_path)
+            filename = os.path.basename(export_path)
 
             # Send the file back to the browser directly from the temp directory
             response = send_file(
-                csv_file_path,
+                export_path,
                 as_attachment=True,
                 download_name=filename,
             )
@@ -131,21 +378,118 @@ def download_csv():
         logger.error("File not found")
         return "File not found", 404
 
-if __name__ == '__main__':
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Expose the pipeline stage histograms in the Prometheus text format"""
+    
+    # Hand over this worker's latest counts first, as only the snapshot files are rendered
+    metrics.save_snapshot("web")
+    
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/slow_queries', methods=['GET'])
+def slow_queries():
+    """Return the slowest statement fingerprints (by total time) with their query plans as JSON"""
+    
+    if not ADMIN_TOKEN:
+        return "Not Found", 404
+    token = request.headers.get('X-Admin-Token', request.args.get('token', ''))
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return "Forbidden", 403
+    
+    top_n = request.args.get('n', default=10, type=int)
+    
+    return jsonify(common.slowest_queries(top_n))
+
+@app.route('/api/events', methods=['POST'])
+@metrics.timed("ingest.total")
+def webhook_events():
+    """Accept pushed availability-change events (a single event or a list) and record them like the poller does.
+       The raw body must be signed with HMAC-SHA256 using the shared secret, hex encoded in the X-Signature header.
+    """
+    
+    if not WEBHOOK_SECRET:
+        logger.error("Event received but ROBOT_TRACKER_WEBHOOK_SECRET isn't set")
+        return jsonify({"error": "Webhook not configured"}), 403
+    
+    expected_signature = hmac.new(WEBHOOK_SECRET.encode('utf-8'), request.get_data(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected_signature, request.headers.get('X-Signature', '')):
+        logger.error("Event received with an invalid signature")
+        return jsonify({"error": "Invalid signature"}), 403
+    
+    events = request.get_json(silent=True)
+    if events is None:
+        return jsonify({"error": "Body must be JSON"}), 400
+    if isinstance(events, dict):
+        events = [events]
+    if not isinstance(events, list) or not all(isinstance(event, dict) for event in events):
+        return jsonify({"error": "Body must be an event object or a list of event objects"}), 400
+    if len(events) > MAX_EVENTS_PER_REQUEST:
+        return jsonify({"error": f"At most {MAX_EVENTS_PER_REQUEST} events per request"}), 413
+    
+    try:
+        summary = robot_usage_tracker.ingest_events(events)
+    except sqlite3.Error as e:
+        logger.error(f"Error recording events: {e}")
+        return jsonify({"error": "Database unavailable"}), 503
+    
+    return jsonify(summary)
+
+@app.route('/live', methods=['GET'])
+def live_dashboard():
+    """Render the live availability dashboard with everyone's latest state from the last day"""
+    
+    states = {state['name']: state for state in common.latest_agent_states(dt.datetime.now() - dt.timedelta(days=1))}
+    
+    return render_template('live.html', teams_hierarchy=common.teams_hierarchy, states=states)
+
+@app.route('/live/stream', methods=['GET'])
+def live_stream():
+    """Server-Sent Events stream of state changes as they're recorded"""
+    
+    client = live.broadcaster.subscribe()
+    
+    def stream():
+        try:
+            # Tell the browser how long to wait before reconnecting
+            yield "retry: 5000\n\n"
+            
+            while live.broadcaster.is_subscribed(client):
+                try:
+                    yield f"data: {client.get(timeout=LIVE_HEARTBEAT)}\n\n"
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+        finally:
+            # Runs when the browser disconnects
+            live.broadcaster.unsubscribe(client)
+    
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def create_scheduler(scheduler_class=BackgroundScheduler):
+    """Create a scheduler with the background jobs added (not started)"""
     
     # Create a scheduler object
-    scheduler = BackgroundScheduler()
+    scheduler = scheduler_class()
     
     # Add jobs to the scheduler
     scheduler.add_job(utilities.delete_old_records, 'cron', day_of_week='sun', hour=12, minute=30)
     scheduler.add_job(utilities.email_main, 'cron', kwargs={'recurrence': 'daily'}, day_of_week='tue-sat', hour=8, minute=50)
     scheduler.add_job(utilities.email_main, 'cron', kwargs={'recurrence': 'weekly'}, day_of_week='mon', hour=8, minute=50)
+    # Shortly after the shift ends (events up to the end of the shift_start hour still count towards the previous shift)
+    scheduler.add_job(utilities.prewarm_reports, 'cron', hour=(common.shifts_times['shift_start'] + 1) % 24, minute=15)
+    # Keep the columnar copy used for report queries up to date
+    if common.report_engine == "duckdb":
+        scheduler.add_job(report_store.sync, 'interval', minutes=report_store.SYNC_INTERVAL, next_run_time=dt.datetime.now())
+    
+    return scheduler
+
+if __name__ == '__main__':
+    
+    # Development server. See wsgi.py/scheduler.py for running under a multi-process WSGI server.
+    scheduler = create_scheduler()
         
     # # Start the scheduler
     scheduler.start()
 
     # Run the Flask app
     app.run(host='localhost', port=5000, debug=True)
-    
-    
-
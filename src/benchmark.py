@@ -0,0 +1,206 @@
+# Standard library imports
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import statistics
+
+# Local application imports
+import common
+import utilities
+import report_store
+import synthetic_data
+import benchmark_email
+
+# Constants
+RESULTS_FOLDER = 'benchmark_results'
+BENCHMARK_USER_ID = 'benchmark'
+
+# Set up a global custom logger object for this script
+logger = common.setup_custom_logger("benchmark")
+
+
+def time_runs(func, repeat: int) -> dict:
+    """Call func repeat times and return timing statistics (seconds) plus whatever the last call reported"""
+    durations = []
+    extra = {}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        extra = func() or {}
+        durations.append(time.perf_counter() - start)
+
+    return {
+        "runs": repeat,
+        "min": round(min(durations), 6),
+        "median": round(statistics.median(durations), 6),
+        "mean": round(statistics.mean(durations), 6),
+        **extra,
+    }
+
+
+def use_fakeredis_if_needed() -> str:
+    """Use the real Redis server if it's up, otherwise fall back to an in-process fakeredis (if installed)"""
+    if common.redis_connect():
+        return "redis"
+
+    try:
+        import fakeredis
+    except ImportError:
+        return None
+
+    server = fakeredis.FakeServer()
+    common.redis_connect = lambda: fakeredis.FakeRedis(server=server)
+    return "fakeredis"
+
+
+def run_suite(args) -> dict:
+    """Generate the synthetic database and run every benchmark against it"""
+
+    work_folder = tempfile.mkdtemp(prefix="robot_benchmark_")
+    database_name = os.path.join(work_folder, "RobotTracker.db")
+
+    roster = synthetic_data.generate(
+        database_name, agents=args.agents, managers=args.managers, days=args.days,
+        state_changes_per_day=args.state_changes, subscribers=args.subscribers, seed=args.seed
+    )
+    agents = [agent for team in roster.values() for agent in team]
+
+    # Point the application at the synthetic database and roster
+    common.DATABASE_NAME = database_name
+    common.teams_hierarchy = roster
+
+    end_date = datetime.date.today()
+    start_date = end_date - datetime.timedelta(days=args.days)
+    start_date_time = datetime.datetime.combine(start_date, datetime.time(3, 0))
+    end_date_time = datetime.datetime.combine(end_date, datetime.time(2, 30))
+
+    sql_query = common.usage_query(agents)
+    query_parameters = [common.to_epoch(start_date_time), common.to_epoch(end_date_time)] + agents
+
+    results = {}
+
+    # Query
+    state = {}
+    def bench_query():
+        state["results"] = common.connect_to_database(sql_query, query_parameters)
+        return {"rows": len(state["results"])}
+    results["query"] = time_runs(bench_query, args.repeat)
+
+    # The same report queries on each engine (see report_store.py)
+    if "duckdb" in args.engines:
+        report_store.REPORT_STORE_FILE = os.path.join(work_folder, "RobotTracker.duckdb")
+        results["report_store_sync"] = time_runs(lambda: {"rows": report_store.sync(database_name)}, 1)
+    
+    rollup_start = end_date_time - datetime.timedelta(days=args.days)
+    for engine in args.engines:
+        common.report_engine = engine
+        until_ts = common.to_epoch(end_date_time)
+        results[f"query_{engine}"] = time_runs(lambda: {"rows": len(common.query_reports(sql_query, query_parameters, until_ts))}, args.repeat)
+        results[f"rollup_{engine}"] = time_runs(lambda: {"rows": len(common.team_rollup(rollup_start, end_date_time))}, args.repeat)
+    common.report_engine = "sqlite"
+    
+    # Sessionization (create_csv)
+    def bench_sessionize():
+        state["csv_file_path"], filename, state["recurrence"] = common.create_csv(state["results"], BENCHMARK_USER_ID)
+        return {"csv_bytes": os.path.getsize(state["csv_file_path"]), "recurrence": state["recurrence"]}
+    results["sessionize"] = time_runs(bench_sessionize, args.repeat)
+
+    # Chart rendering (create_graph)
+    def bench_charts():
+        chart_paths = common.create_graph(state["csv_file_path"], agents, state["recurrence"])
+        return {"charts": len(chart_paths), "chart_bytes": sum(os.path.getsize(path) for path in chart_paths)}
+    results["charts"] = time_runs(bench_charts, args.repeat)
+
+    # Full /filter request through the Flask test client
+    redis_backend = use_fakeredis_if_needed()
+    if redis_backend:
+        import app as web_app
+
+        client = web_app.app.test_client()
+        client.get('/')
+        form = {
+            'startdate': start_date.isoformat(), 'enddate': end_date.isoformat(),
+            'starttime': '03:00', 'endtime': '02:30', 'agent': agents,
+        }
+
+        def bench_filter():
+            response = client.post(f'/filter_{BENCHMARK_USER_ID}', data=form)
+            return {"status": response.status_code, "response_bytes": len(response.data), "redis": redis_backend}
+        results["filter_endpoint"] = time_runs(bench_filter, args.repeat)
+    else:
+        logger.warning("Skipping /filter benchmark: no Redis server and fakeredis isn't installed")
+        results["filter_endpoint"] = {"skipped": "Redis unavailable"}
+
+    # Email job, delivered to a local stub SMTP server
+    controller, handler = benchmark_email.start_stub_smtp()
+    utilities.SMTP_SERVER, utilities.SMTP_PORT = benchmark_email.STUB_SMTP_HOST, benchmark_email.STUB_SMTP_PORT
+    try:
+        def bench_email():
+            received_before = handler.received
+            utilities.email_main('weekly')
+            return {"emails_sent": handler.received - received_before}
+        results["email_job"] = time_runs(bench_email, args.repeat)
+    finally:
+        controller.stop()
+
+    shutil.rmtree(work_folder, ignore_errors=True)
+    return results
+
+
+def compare(current: dict, previous: dict) -> None:
+    """Print the median time of each benchmark against a previous results file"""
+    for name, result in current["benchmarks"].items():
+        old = previous.get("benchmarks", {}).get(name, {})
+        if "median" in result and "median" in old and old["median"]:
+            change = (result["median"] - old["median"]) / old["median"] * 100
+            print(f"{name:<16} {old['median']:>10.4f}s --> {result['median']:>10.4f}s ({change:+.1f}%)")
+        else:
+            print(f"{name:<16} no comparable result")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the report pipeline against a synthetic database")
+    parser.add_argument("--agents", type=int, default=20)
+    parser.add_argument("--managers", type=int, default=2)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--state-changes", type=float, default=6, help="Average state changes per agent per shift")
+    parser.add_argument("--subscribers", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--engines", type=lambda value: value.split(','), default=["sqlite"], help="Report engines to compare, e.g. sqlite,duckdb")
+    parser.add_argument("--output", help="Where to write the JSON results (defaults to benchmark_results/<timestamp>.json)")
+    parser.add_argument("--compare", help="A previous results file to compare against")
+    args = parser.parse_args()
+
+    results = {
+        "metadata": {
+            "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "parameters": {
+                "agents": args.agents, "managers": args.managers, "days": args.days,
+                "state_changes": args.state_changes, "subscribers": args.subscribers,
+                "seed": args.seed, "repeat": args.repeat, "engines": args.engines,
+            },
+        },
+        "benchmarks": run_suite(args),
+    }
+
+    output = args.output or os.path.join(RESULTS_FOLDER, f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as results_file:
+        json.dump(results, results_file, indent=2)
+    logger.info(f"Benchmark results written to {output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as previous_file:
+            compare(results, json.load(previous_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# Standard library imports
+import os
+import time
+import argparse
+import tempfile
+
+# Third-party imports
+from aiosmtpd.controller import Controller
+
+# Local application imports
+import common
+import utilities
+
+# Constants
+STUB_SMTP_HOST = '127.0.0.1'
+STUB_SMTP_PORT = 8025
+AGENT_SETS = 10  # Subscribers are spread across this many agent sets, like a few teams' managers and leads
+
+# Set up a global custom logger object for this script
+logger = common.setup_custom_logger("benchmark_email")
+
+
+class SinkHandler:
+    """aiosmtpd handler that accepts every message and just counts it"""
+
+    def __init__(self):
+        self.received = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received += 1
+        return '250 Message accepted for delivery'
+
+
+def start_stub_smtp(host=STUB_SMTP_HOST, port=STUB_SMTP_PORT):
+    """Start a local aiosmtpd server in a background thread and return the controller and handler"""
+    handler = SinkHandler()
+    controller = Controller(handler, hostname=host, port=port)
+    controller.start()
+    logger.info(f"Stub SMTP server listening on {host}:{port}")
+    return controller, handler
+
+
+def build_fixtures(folder, subscribers, agent_sets):
+    """Write a chart and CSV to disk for each agent set and return one report tuple per fake subscriber (dealt out across the sets)"""
+
+    fixtures = []
+    for agent_set in range(agent_sets):
+        set_folder = os.path.join(folder, f"set{agent_set}")
+        os.makedirs(set_folder)
+        chart_path = os.path.join(set_folder, "graph_2025-02-20.png")
+        csv_file_path = os.path.join(set_folder, "filtered_data_20250221085000.csv")
+
+        # Roughly the size of a real chart and a day's CSV (the PNG signature lets MIMEImage work out the image type)
+        with open(chart_path, 'wb') as img_file:
+            img_file.write(b'\x89PNG\r\n\x1a\n' + os.urandom(40 * 1024))
+        with open(csv_file_path, 'w') as csv_file:
+            csv_file.write("Name,Actual Date,Shift Date,Previous Value,New Value,Time Logged In\n")
+            csv_file.write("Man1Age1,2025-02-20 09:00:00,2025-02-20,0,1,0:00:00\n" * 200)
+        fixtures.append(([chart_path], csv_file_path))
+
+    return [(f"subscriber{i}.test@outlook.com", *fixtures[i % agent_sets], "daily") for i in range(subscribers)]
+
+
+def build_per_message(reports, shift_dates):
+    """How messages were built before build_messages: every message reads and encodes its own copy of the charts and CSV"""
+    return [utilities.build_email(*report[:3], shift_dates, report[3]) for report in reports]
+
+
+def run_benchmark(subscribers, connections, port=STUB_SMTP_PORT, agent_sets=AGENT_SETS, shared=True):
+    """Build and send one email per subscriber through the stub server and return messages per second.
+       shared builds the messages like the email job (utilities.build_messages), otherwise each one encodes its own attachments.
+    """
+
+    controller, handler = start_stub_smtp(port=port)
+    shift_dates = ["2025-02-20"]
+
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            reports = build_fixtures(folder, subscribers, agent_sets)
+
+            start = time.perf_counter()
+            messages = utilities.build_messages(reports, shift_dates) if shared else build_per_message(reports, shift_dates)
+            build_seconds = time.perf_counter() - start
+
+            sent, failed = utilities.deliver_emails(messages, host=STUB_SMTP_HOST, port=port, connections=connections)
+            total_seconds = time.perf_counter() - start
+    finally:
+        controller.stop()
+
+    results = {
+        "subscribers": subscribers,
+        "agent_sets": agent_sets,
+        "connections": connections,
+        "shared_attachments": shared,
+        "sent": sent,
+        "failed": len(failed),
+        "received": handler.received,
+        "build_seconds": round(build_seconds, 3),
+        "total_seconds": round(total_seconds, 3),
+        "messages_per_second": round(sent / total_seconds, 1) if total_seconds else None,
+    }
+    logger.info(f"Email benchmark results: {results}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure email fan-out throughput against a local stub SMTP server")
+    parser.add_argument("--subscribers", type=int, default=500)
+    parser.add_argument("--agent-sets", type=int, default=AGENT_SETS, help="Distinct agent sets the subscribers are spread across")
+    parser.add_argument("--connections", type=int, default=utilities.SMTP_CONNECTIONS)
+    parser.add_argument("--port", type=int, default=STUB_SMTP_PORT)
+    args = parser.parse_args()
+
+    # Encoding each message's attachments separately first, then sharing them per agent set like the email job
+    for shared in (False, True):
+        results = run_benchmark(args.subscribers, args.connections, args.port, args.agent_sets, shared)
+        print(f"{'Shared' if shared else 'Per message'} attachments: {results['sent']} messages in {results['total_seconds']}s "
+              f"(building took {results['build_seconds']}s) --> {results['messages_per_second']} messages/second")
+
+
+if __name__ == '__main__':
+    main()
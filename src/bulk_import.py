@@ -0,0 +1,301 @@
+# Standard library imports
+import os
+import csv
+import json
+import time
+import sqlite3
+import argparse
+import datetime
+
+# Local application imports
+import common
+import schema
+import metrics
+
+# Constants
+BATCH_ROWS = 50000  # Events parsed and staged per executemany call
+INDEX_REBUILD_MIN_ROWS = 100000  # Below this it's quicker to insert through the existing AgentEvent indexes
+MAX_LOGGED_REJECTS = 20  # Only log the first few bad lines, the rest are just counted
+AVAILABLE_VALUES = {"true": 1, "1": 1, "yes": 1, "false": 0, "0": 0, "no": 0}
+EVENT_FIELDS = ("name", "email", "available", "timestamp")
+
+# Raw events go into a TEMP table first (no indexes, and no lock on the main database while the files are read)
+SQL_CREATE_STAGING = """
+CREATE TABLE IF NOT EXISTS temp.ImportEvent (
+    AGENT_ID INTEGER NOT NULL,
+    TS INTEGER NOT NULL,
+    SHIFT_DAY INTEGER NOT NULL,
+    AVAILABLE INTEGER NOT NULL
+)
+"""
+SQL_INSERT_STAGING = "INSERT INTO temp.ImportEvent (AGENT_ID, TS, SHIFT_DAY, AVAILABLE) VALUES (?, ?, ?, ?)"
+SQL_UPDATE_AGENT_EMAIL = "UPDATE Agent SET EMAIL = ? WHERE ID = ?"
+
+# Turn the raw observations into the rows record_agent_state would have written: the first event of each agent's shift
+# (PREVIOUS_VALUE = NEW_VALUE) and every state change after it. The rows the database already holds for the same agent
+# shifts are merged into the sequence (e.g. when filling a poller outage mid-shift). If an event lands on the exact time of
+# an existing row, the existing row is kept when they agree and replaced when they don't, which makes re-running a file a no-op.
+# Every row from the first imported event of a shift onwards is worked out again: the imported events that change state
+# are kept, and existing rows after them get their PREVIOUS_VALUE recomputed, or are deleted if they no longer change state.
+SQL_SELECT_REPLACED_EVENTS = """
+CREATE TABLE temp.ReplacedEvent AS
+SELECT DISTINCT e.rowid AS EVENT_ROWID
+FROM temp.ImportEvent i
+JOIN main.AgentEvent e ON e.AGENT_ID = i.AGENT_ID AND e.TS = i.TS AND e.NEW_VALUE != i.AVAILABLE
+"""
+SQL_SELECT_MERGED_EVENTS = """
+CREATE TABLE temp.MergedEvent AS
+WITH shifts AS (
+    SELECT DISTINCT AGENT_ID, SHIFT_DAY FROM temp.ImportEvent
+),
+existing AS (
+    SELECT e.rowid AS EVENT_ROWID, e.AGENT_ID, e.TS, e.SHIFT_DAY, e.NEW_VALUE AS AVAILABLE, e.PREVIOUS_VALUE AS RECORDED_PREVIOUS,
+           e.rowid IN (SELECT EVENT_ROWID FROM temp.ReplacedEvent) AS REPLACED
+    FROM shifts s
+    JOIN main.AgentEvent e ON e.AGENT_ID = s.AGENT_ID AND e.SHIFT_DAY = s.SHIFT_DAY
+),
+combined AS (
+    SELECT EVENT_ROWID, AGENT_ID, TS, SHIFT_DAY, AVAILABLE, RECORDED_PREVIOUS, 0 AS IMPORTED FROM existing WHERE NOT REPLACED
+    UNION ALL
+    SELECT NULL, i.AGENT_ID, i.TS, i.SHIFT_DAY, i.AVAILABLE, NULL, 1
+    FROM temp.ImportEvent i
+    WHERE NOT EXISTS (SELECT 1 FROM main.AgentEvent e WHERE e.AGENT_ID = i.AGENT_ID AND e.TS = i.TS AND e.NEW_VALUE = i.AVAILABLE)
+),
+ordered AS (
+    SELECT *,
+           LAG(AVAILABLE) OVER (PARTITION BY AGENT_ID, SHIFT_DAY ORDER BY TS, IMPORTED) AS PREVIOUS_AVAILABLE,
+           MIN(CASE WHEN IMPORTED = 1 THEN TS END) OVER (PARTITION BY AGENT_ID, SHIFT_DAY) AS FIRST_IMPORTED_TS
+    FROM combined
+)
+SELECT EVENT_ROWID, AGENT_ID, TS, SHIFT_DAY, IMPORTED, RECORDED_PREVIOUS,
+       COALESCE(PREVIOUS_AVAILABLE, AVAILABLE) AS PREVIOUS_VALUE,
+       AVAILABLE AS NEW_VALUE,
+       PREVIOUS_AVAILABLE IS NULL OR PREVIOUS_AVAILABLE != AVAILABLE AS CHANGED
+FROM ordered
+WHERE IMPORTED = 1 OR TS > FIRST_IMPORTED_TS
+UNION ALL
+-- Existing rows contradicted by an imported event at the same time (CHANGED = 0, so they're deleted)
+SELECT EVENT_ROWID, AGENT_ID, TS, SHIFT_DAY, 0, RECORDED_PREVIOUS, RECORDED_PREVIOUS, AVAILABLE, 0
+FROM existing
+WHERE REPLACED
+"""
+SQL_INDEX_MERGED_EXISTING = "CREATE INDEX temp.idx_mergedevent_rowid ON MergedEvent (EVENT_ROWID) WHERE IMPORTED = 0"
+SQL_COUNT_NEW_EVENTS = "SELECT COUNT(*) FROM temp.MergedEvent WHERE IMPORTED = 1 AND CHANGED"
+SQL_INSERT_NEW_EVENTS = """
+INSERT INTO main.AgentEvent (AGENT_ID, TS, SHIFT_DAY, PREVIOUS_VALUE, NEW_VALUE)
+SELECT AGENT_ID, TS, SHIFT_DAY, PREVIOUS_VALUE, NEW_VALUE FROM temp.MergedEvent WHERE IMPORTED = 1 AND CHANGED ORDER BY TS
+"""
+SQL_DELETE_UNCHANGED_EVENTS = """
+DELETE FROM main.AgentEvent
+WHERE rowid IN (SELECT EVENT_ROWID FROM temp.MergedEvent WHERE IMPORTED = 0 AND NOT CHANGED)
+"""
+SQL_UPDATE_PREVIOUS_VALUES = """
+UPDATE main.AgentEvent
+SET PREVIOUS_VALUE = (SELECT m.PREVIOUS_VALUE FROM temp.MergedEvent m WHERE m.IMPORTED = 0 AND m.EVENT_ROWID = AgentEvent.rowid)
+WHERE rowid IN (SELECT EVENT_ROWID FROM temp.MergedEvent WHERE IMPORTED = 0 AND CHANGED AND PREVIOUS_VALUE != RECORDED_PREVIOUS)
+"""
+SQL_SELECT_EVENT_INDEXES = "SELECT name, sql FROM main.sqlite_master WHERE type = 'index' AND tbl_name = 'AgentEvent' AND sql IS NOT NULL"
+
+# Set up a global custom logger object for this script
+logger = common.setup_custom_logger("bulk_import")
+
+
+def parse_event(name, email, available, timestamp, agent_ids: dict, emails: dict, shift_start: int) -> tuple:
+    """Validate one event (same fields as the /api/events webhook, but the timestamp is required) and return the staging row.
+       Raises ValueError with the reason if the event is invalid.
+    """
+
+    agent_id = agent_ids.get(name)
+    if agent_id is None:
+        raise ValueError(f"Agent {name!r} is not in the teams hierarchy")
+    if email:
+        emails[agent_id] = email
+
+    # JSON gives us booleans, CSV the usual spellings
+    if isinstance(available, bool):
+        available = int(available)
+    else:
+        available = AVAILABLE_VALUES.get(str(available).strip().lower())
+        if available is None:
+            raise ValueError("'available' must be true or false")
+
+    if not timestamp:
+        raise ValueError("Missing timestamp")
+    try:
+        date_time = datetime.datetime.fromisoformat(str(timestamp))
+    except ValueError:
+        raise ValueError(f"Invalid timestamp {timestamp!r}")
+    # The database holds local (naive) times, like the poller records
+    if date_time.tzinfo:
+        date_time = date_time.astimezone().replace(tzinfo=None)
+
+    # Same shift rule as record_agent_state: up to e.g. 2:59am is credited to the previous day's shift
+    ts = common.to_epoch(date_time)
+    shift_day = ts // 86400 - (1 if date_time.hour <= shift_start else 0)
+
+    return (agent_id, ts, shift_day, available)
+
+
+def read_events(path: str, file_format: str):
+    """Yield (line number, (name, email, available, timestamp), error) for each event in a CSV file (with a header row)
+       or a JSONL file. error is set (and the fields None) if the line couldn't be read at all.
+    """
+    with open(path, 'r', encoding='utf-8', newline='') as events_file:
+        if file_format == 'csv':
+            reader = csv.reader(events_file)
+            header = [column.strip().lower() for column in next(reader, [])]
+            missing = [field for field in EVENT_FIELDS if field != "email" and field not in header]
+            if missing:
+                raise ValueError(f"{path} is missing the {', '.join(missing)} column(s)")
+
+            name_column, available_column, timestamp_column = header.index("name"), header.index("available"), header.index("timestamp")
+            email_column = header.index("email") if "email" in header else None
+
+            for row in reader:
+                try:
+                    email = row[email_column] if email_column is not None else None
+                    yield reader.line_num, (row[name_column], email, row[available_column], row[timestamp_column]), None
+                except IndexError:
+                    yield reader.line_num, None, f"Expected {len(header)} columns, got {len(row)}"
+        else:
+            for line_number, line in enumerate(events_file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    event = json.loads(line)
+                    yield line_number, tuple(event.get(field) for field in EVENT_FIELDS), None
+                except (json.JSONDecodeError, AttributeError):
+                    yield line_number, None, "Not a JSON object"
+
+
+def stage_file(conn, path: str, file_format: str, agent_ids: dict, emails: dict, totals: dict) -> None:
+    """Parse a file into the staging table in BATCH_ROWS sized executemany calls"""
+
+    shift_start = common.shifts_times['shift_start']
+    batch = []
+
+    for line, fields, error in read_events(path, file_format):
+        totals["read"] += 1
+        try:
+            if error:
+                raise ValueError(error)
+            batch.append(parse_event(*fields, agent_ids, emails, shift_start))
+        except ValueError as e:
+            totals["rejected"] += 1
+            if totals["rejected"] <= MAX_LOGGED_REJECTS:
+                logger.warning(f"{path} line {line}: rejected, {e}")
+            continue
+
+        if len(batch) >= BATCH_ROWS:
+            conn.executemany(SQL_INSERT_STAGING, batch)
+            batch = []
+
+    if batch:
+        conn.executemany(SQL_INSERT_STAGING, batch)
+
+
+def file_format_for(path: str, file_format: str = None) -> str:
+    """Use the format given, otherwise go by the file extension"""
+    if file_format:
+        return file_format
+    return 'csv' if os.path.splitext(path)[1].lower() == '.csv' else 'jsonl'
+
+
+@metrics.timed("bulk_import.total")
+def import_files(paths: list, file_format: str = None, database_name: str = None, rebuild_indexes: str = "auto") -> dict:
+    """Load historical availability events from CSV/JSONL files into AgentEvent.
+       Returns how many events were read, rejected and imported, how many existing rows were corrected or removed around them,
+       and the rows per second achieved.
+    """
+
+    roster = {agent for team in common.teams_hierarchy.values() for agent in team}
+    emails = {}
+    totals = {"read": 0, "rejected": 0, "imported": 0, "corrected": 0, "removed": 0}
+    start = time.perf_counter()
+
+    # ensure_schema adds every rostered agent to Agent (see sync_agent_managers), so we can look up their IDs while parsing
+    schema.ensure_schema(database_name)
+
+    # Transactions are managed explicitly below, so the staging load never holds a lock on the main database
+    conn = sqlite3.connect(database_name or common.DATABASE_NAME, timeout=30, isolation_level=None)
+    try:
+        agent_ids = {name: agent_id for agent_id, name in conn.execute("SELECT ID, NAME FROM Agent") if name in roster}
+
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute(SQL_CREATE_STAGING)
+
+        # 1. Parse and stage every file (TEMP table only)
+        with metrics.time_stage("bulk_import.stage"):
+            conn.execute("BEGIN")
+            for path in paths:
+                logger.info(f"Reading {path}")
+                stage_file(conn, path, file_format_for(path, file_format), agent_ids, emails, totals)
+            conn.execute("COMMIT")
+
+        # 2. Apply it in one write transaction
+        with metrics.time_stage("bulk_import.load"):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(SQL_UPDATE_AGENT_EMAIL, [(email, agent_id) for agent_id, email in emails.items()])
+                conn.execute(SQL_SELECT_REPLACED_EVENTS)
+                conn.execute(SQL_SELECT_MERGED_EVENTS)
+                conn.execute(SQL_INDEX_MERGED_EXISTING)
+                totals["imported"] = conn.execute(SQL_COUNT_NEW_EVENTS).fetchone()[0]
+
+                existing = conn.execute("SELECT COUNT(*) FROM main.AgentEvent").fetchone()[0]
+                rebuild = rebuild_indexes == "always" or (
+                    rebuild_indexes == "auto" and totals["imported"] >= INDEX_REBUILD_MIN_ROWS and totals["imported"] > existing
+                )
+
+                # Maintaining three indexes row by row is most of the cost of a big insert, so for a load bigger than the
+                # table (e.g. a first backfill) drop them and build them again once the rows are in
+                indexes = conn.execute(SQL_SELECT_EVENT_INDEXES).fetchall() if rebuild else []
+                for name, _ in indexes:
+                    conn.execute(f"DROP INDEX main.{name}")
+
+                # Fix up the existing rows that come after a backfilled event before adding the new ones
+                # (rowids in MergedEvent still point at the rows read above, as we hold the write lock)
+                totals["corrected"] = conn.execute(SQL_UPDATE_PREVIOUS_VALUES).rowcount
+                totals["removed"] = conn.execute(SQL_DELETE_UNCHANGED_EVENTS).rowcount
+                conn.execute(SQL_INSERT_NEW_EVENTS)
+
+                for name, sql in indexes:
+                    logger.info(f"Rebuilding index {name}")
+                    conn.execute(sql)
+
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+    finally:
+        conn.close()
+
+    elapsed = time.perf_counter() - start
+    totals["seconds"] = round(elapsed, 3)
+    totals["rows_per_second"] = int(totals["read"] / elapsed) if elapsed else 0
+    totals["skipped"] = totals["read"] - totals["rejected"] - totals["imported"]
+
+    metrics.observe_rows("bulk_import.imported", totals["imported"])
+    logger.info(
+        f"Bulk import finished in {elapsed:.2f}s ({totals['rows_per_second']} rows/s): {totals['read']} read, "
+        f"{totals['imported']} imported, {totals['skipped']} already recorded or unchanged, {totals['rejected']} rejected, "
+        f"{totals['corrected']} existing rows given a new previous value, {totals['removed']} existing rows no longer a change removed"
+    )
+
+    return totals
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bulk import historical availability events from CSV or JSONL files")
+    parser.add_argument("files", nargs='+', help="CSV (name,email,available,timestamp header) or JSONL files, one event per row/line")
+    parser.add_argument("--format", choices=("csv", "jsonl"), help="File format (defaults to the file extension)")
+    parser.add_argument("--database", help="SQLite database to load into (defaults to the app's database)")
+    parser.add_argument("--rebuild-indexes", choices=("auto", "always", "never"), default="auto",
+                        help="Drop and rebuild the AgentEvent indexes around the insert (auto = only for loads bigger than the table)")
+    args = parser.parse_args()
+
+    totals = import_files(args.files, args.format, args.database, args.rebuild_indexes)
+    print(json.dumps(totals, indent=2))
+
+    # Leave the timings where the web app's /metrics endpoint can pick them up
+    metrics.save_snapshot("bulk_import")
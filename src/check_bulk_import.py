@@ -0,0 +1,128 @@
+# Standard library imports
+import os
+import sys
+import csv
+import random
+import sqlite3
+import argparse
+import datetime
+import tempfile
+
+# Local application imports
+import common
+import schema
+import bulk_import
+import robot_usage_tracker
+
+# Constants
+SQL_SELECT_EVENTS = "SELECT a.NAME, e.TS, e.SHIFT_DAY, e.PREVIOUS_VALUE, e.NEW_VALUE FROM AgentEvent e JOIN Agent a ON a.ID = e.AGENT_ID ORDER BY a.NAME, e.TS"
+FIRST_DAY = datetime.datetime(2025, 2, 17)
+
+# Set up a global custom logger object for this script
+logger = common.setup_custom_logger("check_bulk_import")
+
+
+def record(database_name: str, events: list) -> None:
+    """Record (name, date_time, available) events one at a time, exactly as the poller does"""
+    conn = sqlite3.connect(database_name)
+    agent_ids = {}
+    with conn:
+        cursor = conn.cursor()
+        for name, date_time, available in sorted(events, key=lambda event: event[1]):
+            agent = {'available': available, 'contact': {'name': name, 'email': None}}
+            robot_usage_tracker.record_agent_state(cursor, agent, date_time, agent_ids)
+    conn.close()
+
+
+def import_events(database_name: str, folder: str, events: list) -> dict:
+    """Write the events to a CSV file and bulk import it"""
+    path = os.path.join(folder, "events.csv")
+    with open(path, 'w', encoding='utf-8', newline='') as events_file:
+        writer = csv.writer(events_file)
+        writer.writerow(["name", "available", "timestamp"])
+        for name, date_time, available in events:
+            writer.writerow([name, "true" if available else "false", date_time.isoformat()])
+    return bulk_import.import_files([path], database_name=database_name)
+
+
+def recorded_events(database_name: str) -> list:
+    """Return every AgentEvent row as (name, TS, SHIFT_DAY, PREVIOUS_VALUE, NEW_VALUE)"""
+    conn = sqlite3.connect(database_name)
+    rows = conn.execute(SQL_SELECT_EVENTS).fetchall()
+    conn.close()
+    return rows
+
+
+def check_scenario(folder: str, polled: list, backfilled: list) -> list:
+    """Record the polled events, then bulk import the backfilled ones (twice). The result must match what the poller would
+       have recorded had it seen the backfilled events along with the ones it recorded, and the second import must change nothing.
+       (The poller only keeps changes, so the polled events it didn't record can't be taken into account.) Returns what went wrong.
+    """
+
+    problems = []
+    expected_database = os.path.join(folder, "expected.db")
+    imported_database = os.path.join(folder, "imported.db")
+    for database_name in (expected_database, imported_database):
+        if os.path.exists(database_name):
+            os.remove(database_name)
+        schema.ensure_schema(database_name)
+
+    record(imported_database, polled)
+    recorded = [(name, common.from_epoch(ts), bool(available)) for name, ts, _, _, available in recorded_events(imported_database)]
+    record(expected_database, recorded + backfilled)
+    import_events(imported_database, folder, backfilled)
+
+    expected, imported = recorded_events(expected_database), recorded_events(imported_database)
+    if imported != expected:
+        problems.append(f"expected {expected}, got {imported}")
+
+    totals = import_events(imported_database, folder, backfilled)
+    if totals["imported"] or totals["corrected"] or totals["removed"]:
+        problems.append(f"re-running the import changed the database: {totals}")
+
+    return problems
+
+
+def mid_shift_backfill() -> tuple:
+    """The poller saw 08:00 logged in and 14:00 logged out, but missed a logout at 10:30 (e.g. it was down).
+       The 14:00 row must be removed, otherwise reports count 08:00 --> 14:00 instead of 08:00 --> 10:30.
+    """
+    name = next(agent for team in common.teams_hierarchy.values() for agent in team)
+    polled = [(name, FIRST_DAY.replace(hour=8), True), (name, FIRST_DAY.replace(hour=14), False)]
+    backfilled = [(name, FIRST_DAY.replace(hour=10, minute=30), False)]
+    return polled, backfilled
+
+
+def random_scenario(generator: random.Random, agents: list) -> tuple:
+    """A few shifts of random events per agent, some seen by the poller and the rest backfilled"""
+    polled, backfilled = [], []
+    for name in agents:
+        date_time = FIRST_DAY
+        for _ in range(generator.randint(1, 40)):
+            date_time += datetime.timedelta(minutes=generator.randint(1, 600))
+            event = (name, date_time, generator.random() < 0.5)
+            (polled if generator.random() < 0.5 else backfilled).append(event)
+    return polled, backfilled
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check bulk imports that fill gaps in recorded shifts match what the poller would have recorded")
+    parser.add_argument("--scenarios", type=int, default=200, help="How many random scenarios to check")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generator = random.Random(args.seed)
+    agents = [agent for team in common.teams_hierarchy.values() for agent in team][:3]
+    failures = 0
+
+    with tempfile.TemporaryDirectory() as folder:
+        scenarios = [("mid-shift backfill", mid_shift_backfill())]
+        scenarios += [(f"random scenario {number}", random_scenario(generator, agents)) for number in range(args.scenarios)]
+
+        for description, (polled, backfilled) in scenarios:
+            for problem in check_scenario(folder, polled, backfilled):
+                failures += 1
+                print(f"{description}: {problem}")
+
+    print(f"{failures} failure(s) over {len(scenarios)} scenario(s)")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,95 @@
+# Standard library imports
+import os
+import sys
+import json
+import argparse
+import datetime
+import subprocess
+from types import SimpleNamespace
+
+# Local application imports
+import common
+import utilities
+
+# Constants
+SCRIPTS_FILE = os.path.join('static', 'scripts.js')
+PRESET_FUNCTIONS = {
+    "yesterday": "setYesterday",
+    "last_week": "setLastWeek",
+    "last_month": "setLastMonth",
+    "last_three_months": "setLastThreeMonths",
+}
+
+# Runs the preset buttons' functions from scripts.js under node, with "today" pinned to each date in turn, and prints
+# the form values each one sets. The page only ever reads those four inputs, so a stub document is enough.
+NODE_SCRIPT = """
+const fs = require('fs');
+const vm = require('vm');
+const [scriptsFile, functionsJson, datesJson] = process.argv.slice(1);
+const functions = JSON.parse(functionsJson);
+const results = {};
+for (const day of JSON.parse(datesJson)) {
+    const now = new Date(day + 'T12:00:00');
+    class PinnedDate extends Date {
+        constructor(...args) { if (args.length) { super(...args); } else { super(now.getTime()); } }
+        static now() { return now.getTime(); }
+    }
+    const inputs = {};
+    const document = { getElementById: (id) => (inputs[id] = inputs[id] || {}) };
+    const context = vm.createContext({ Date: PinnedDate, document, console });
+    vm.runInContext(fs.readFileSync(scriptsFile, 'utf8'), context);
+    results[day] = {};
+    for (const [preset, name] of Object.entries(functions)) {
+        vm.runInContext(name + '()', context);
+        results[day][preset] = {
+            startdate: inputs.startdatelabel.value, enddate: inputs.enddatelabel.value,
+            starttime: inputs.starttimelabel.value, endtime: inputs.endtimelabel.value,
+        };
+    }
+}
+console.log(JSON.stringify(results));
+"""
+
+# Set up a global custom logger object for this script
+logger = common.setup_custom_logger("check_presets")
+
+
+def browser_forms(dates: list) -> dict:
+    """Return {date: {preset: form fields}} as the homepage would submit them on each date"""
+    output = subprocess.run(
+        ["node", "-e", NODE_SCRIPT, SCRIPTS_FILE, json.dumps(PRESET_FUNCTIONS), json.dumps([day.isoformat() for day in dates])],
+        capture_output=True, text=True, check=True, env={**os.environ, "TZ": "UTC"},
+    )
+    return json.loads(output.stdout)
+
+
+def check(dates: list) -> list:
+    """Compare the report cache key of each preset the browser submits with the one prewarm_reports caches it under.
+       Returns a description of every mismatch.
+    """
+
+    mismatches = []
+    forms = browser_forms(dates)
+
+    for day in dates:
+        for preset, (start_date_time, end_date_time) in utilities.preset_ranges(day).items():
+            # Parse the form exactly as /filter does
+            browser_start, browser_end = common.create_datetime_object(SimpleNamespace(form=forms[day.isoformat()][preset]))
+            if common.report_cache_key(browser_start, browser_end, []) != common.report_cache_key(start_date_time, end_date_time, []):
+                mismatches.append(f"{day} {preset}: browser submits {browser_start} - {browser_end}, pre-warmed {start_date_time} - {end_date_time}")
+
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the homepage preset buttons hit the pre-warmed report cache (needs node)")
+    parser.add_argument("--days", type=int, default=366, help="How many days to check, counting back from today")
+    args = parser.parse_args()
+
+    today = datetime.date.today()
+    mismatches = check([today - datetime.timedelta(days=offset) for offset in range(args.days)])
+
+    for mismatch in mismatches:
+        print(mismatch)
+    print(f"{len(mismatches)} mismatch(es) over {args.days} day(s)")
+    sys.exit(1 if mismatches else 0)
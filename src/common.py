@@ -1,13 +1,20 @@
 # Standard library imports
 import os
+import re
 import csv
 import json
+import hashlib
 import logging
 import secrets
 import sqlite3
+import tempfile
+import threading
+import functools
 import datetime as dt
 from datetime import datetime, timedelta, time
+from time import perf_counter
 from itertools import chain
+from collections import Counter
 from typing import List, Optional
 from pathlib import Path
 
@@ -17,16 +24,89 @@ import redis.exceptions
 import pandas as pd
 import matplotlib
 matplotlib.use("Agg")  # Non-interactive backend - ensures the graph is processed and saved without relying on a GUI.
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure  # Used instead of pyplot, whose global "current figure" isn't thread safe
+from matplotlib.colors import TwoSlopeNorm
+
+# Optional: only needed for Parquet/Arrow exports
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 
 # Constants 
 DATABASE_NAME = 'RobotTracker.db'
 EXPECTED_TIME_IN_ROBOT = 5
 CACHE_TTL = 3600  # 1 hour
+REPORT_CACHE_TTL = 25 * 3600  # Pre-warmed reports last until just after the next daily pre-warm run
+SUMMARY_CHART_THRESHOLD = 7  # Reports with more periods (days/weeks) than this get one summary heatmap instead of a chart per period
+SUMMARY_CHART_NAME = "graph_summary.png"
+CHART_FOLDER = os.path.join('static', 'temp')  # Where create_csv/create_graph write each user's report and charts
+CHART_MAX_AGE = 365 * 24 * 3600  # Seconds browsers may keep the chart of a finished day/week (its URL changes if it's ever re-rendered)
+EXPORT_FORMATS = ("csv", "parquet", "arrow")
+EXPORT_BLOCK_SIZE = 1 << 20  # Bytes of CSV converted at a time, so large exports never sit in memory whole
 USER_ID_LENGTH = 16
 DB_PROBE_INTERVAL = 30
 DESIRED_DAILY_AVAIL = 5
+SECRET_KEY_FILE = 'secret_key'  # Shared by every worker process so they can all verify each other's session cookies
+SESSION_LIFETIME = timedelta(days=30)
+CHANGES_CHANNEL = 'agent_state_changes'  # Redis pub/sub channel the poller/webhook publish recorded state changes to
+EPOCH = datetime(1970, 1, 1)  # AgentEvent stores times as seconds (TS) and days (SHIFT_DAY) since this point
+MAX_DAILY_AVAIL = 8  # Hours. Nobody is credited with more than this per shift (same cap as create_csv)
+ORG_LABEL = 'All Teams'  # Name of the org-wide row in team rollups
+
+# Team rollup, computed entirely in SQLite so summary reports never pull raw events into Python.
+# {roster} is the placeholder list of rostered agent names, {period} groups shift days into days or weeks.
+TEAM_ROLLUP_QUERY = """
+WITH roster AS (
+    SELECT ID, MANAGER FROM Agent WHERE NAME IN ({roster})
+),
+intervals AS (
+    -- Each event alongside the time of the agent's next event in the same shift
+    SELECT e.AGENT_ID, e.SHIFT_DAY, e.TS, e.NEW_VALUE,
+           LEAD(e.TS) OVER (PARTITION BY e.AGENT_ID, e.SHIFT_DAY ORDER BY e.TS, e.rowid) AS NEXT_TS
+    FROM AgentEvent e JOIN roster r ON r.ID = e.AGENT_ID
+    WHERE e.TS BETWEEN ? AND ?
+),
+shifts AS (
+    -- Per agent per shift: time between each available event and the next event, plus any still open at the end of the shift
+    SELECT AGENT_ID, SHIFT_DAY, COUNT(*) AS EVENTS,
+           SUM(CASE WHEN NEW_VALUE = 1 AND NEXT_TS IS NOT NULL THEN NEXT_TS - TS ELSE 0 END) AS CLOSED_SECONDS,
+           MAX(CASE WHEN NEW_VALUE = 1 AND NEXT_TS IS NULL THEN (SHIFT_DAY + 1) * 86400 + ? - TS END) AS OPEN_SECONDS
+    FROM intervals GROUP BY AGENT_ID, SHIFT_DAY
+),
+daily AS (
+    -- Same rules as create_csv: available all shift with no changes counts as the cap, an open session only counts if
+    -- nothing was closed, and everything is capped
+    SELECT AGENT_ID, SHIFT_DAY,
+           CASE WHEN CLOSED_SECONDS > 0 THEN CLOSED_SECONDS
+                WHEN EVENTS = 1 AND OPEN_SECONDS IS NOT NULL THEN ?
+                ELSE COALESCE(OPEN_SECONDS, 0) END AS SECONDS
+    FROM shifts
+),
+capped AS (
+    -- (Written as a CASE rather than MIN(x, y) so the query runs unchanged on DuckDB)
+    SELECT AGENT_ID, SHIFT_DAY, CASE WHEN SECONDS > ? THEN ? ELSE SECONDS END AS SECONDS FROM daily
+),
+per_agent AS (
+    SELECT AGENT_ID, {period} AS PERIOD, SUM(SECONDS) AS SECONDS FROM capped GROUP BY AGENT_ID, PERIOD
+),
+team_periods AS (
+    -- Every rostered team for every period, so agents (and teams) with no events count as zero hours
+    SELECT r.MANAGER, p.PERIOD, COUNT(*) AS AGENTS, COALESCE(SUM(pa.SECONDS), 0) AS SECONDS,
+           COUNT(CASE WHEN pa.SECONDS >= ? THEN 1 END) AS AT_TARGET
+    FROM roster r CROSS JOIN (SELECT DISTINCT PERIOD FROM per_agent) p
+    LEFT JOIN per_agent pa ON pa.AGENT_ID = r.ID AND pa.PERIOD = p.PERIOD
+    GROUP BY r.MANAGER, p.PERIOD
+)
+SELECT 0 AS IS_ORG, MANAGER, PERIOD, AGENTS, SECONDS, AT_TARGET FROM team_periods
+UNION ALL
+SELECT 1, NULL, PERIOD, SUM(AGENTS), SUM(SECONDS), SUM(AT_TARGET) FROM team_periods GROUP BY PERIOD
+ORDER BY PERIOD, IS_ORG, MANAGER
+"""
 
 
 def setup_custom_logger(name):
@@ -90,6 +170,9 @@ with open('static/config.json', 'r', encoding='UTF-8') as file:
     valid_domains = data["valid_domains"]
     shifts_times = data["shifts_times"] 
     database_years = data["database_years_to_keep"]
+    slow_query_ms = data.get("slow_query_ms", 250)
+    # "sqlite", or "duckdb" to run report queries on a columnar copy (see report_store.py)
+    report_engine = os.environ.get('ROBOT_TRACKER_REPORT_ENGINE') or data.get("report_engine", "sqlite")
     logger.info("Config data loaded successfully")
 
 # *** HELPER FUNCTIONS ***
@@ -108,6 +191,9 @@ def connect_to_database(query: str, query_parameters: Optional[List] = None, ema
         
         logger.info("Connected to database.")
         
+        # Start timing the statement (SQLite does most of the work while we fetch, so that's timed too)
+        start = perf_counter()
+        
         # Unpack the data tuple using the * operator to ensure each element is passed as a separate argument
         if query_parameters:
             cursor.execute(query, (*query_parameters,))
@@ -118,9 +204,12 @@ def connect_to_database(query: str, query_parameters: Optional[List] = None, ema
         if not email:
             logger.info("Fetching all results from database...")
             results = cursor.fetchall()
+            record_query_stats(conn, query, query_parameters, perf_counter() - start)
             logger.info(f"Results fetched: {len(results)}")
+            conn.close()
             return results
         else:
+            record_query_stats(conn, query, query_parameters, perf_counter() - start)
             logger.info("Email database updated.")
         
         # Commit the changes
@@ -137,14 +226,289 @@ def connect_to_database(query: str, query_parameters: Optional[List] = None, ema
         return
 
 
-def generate_user_id(app):
+# *** QUERY STATISTICS ***
+# Fingerprint -> {"count", "total_ms", "max_ms", "plan"}. Kept per process.
+query_stats = {}
+query_stats_lock = threading.Lock()
+
+def query_reports(query: str, query_parameters: List, until_ts: int) -> List:
+    """Run a read-only report query (usage_query/TEAM_ROLLUP_QUERY) that covers events up to until_ts (epoch seconds).
+       With report_engine set to "duckdb" it runs on the columnar copy when that's recent enough, otherwise on SQLite.
+    """
+    if report_engine == "duckdb":
+        # Imported here as report_store imports this module
+        import report_store
+        results = report_store.query(query, query_parameters, until_ts)
+        if results is not None:
+            return results
+    
+    return connect_to_database(query, query_parameters)
+
+def query_fingerprint(query: str) -> str:
+    """Normalize a statement so the same query with a different number of placeholders counts as one.
+       E.g. NAME IN (?,?,?) and NAME IN (?,?) both become NAME IN (?+)
+    """
+    fingerprint = re.sub(r'\?(\s*,\s*\?)+', '?+', query)
+    return re.sub(r'\s+', ' ', fingerprint).strip()
+
+def parameters_shape(query_parameters: Optional[List]) -> str:
+    """Describe the parameters without logging their values, e.g. '122 params: datetime x2, str x120'"""
+    if not query_parameters:
+        return "0 params"
+    
+    counts = Counter(type(parameter).__name__ for parameter in query_parameters)
+    return f"{len(query_parameters)} params: " + ", ".join(f"{name} x{count}" for name, count in counts.items())
+
+def record_query_stats(conn, query: str, query_parameters: Optional[List], duration: float) -> None:
+    """Record the statement's timing, capture its query plan the first time we see it and log it if it's slow"""
+    
+    fingerprint = query_fingerprint(query)
+    duration_ms = duration * 1000
+    
+    with query_stats_lock:
+        stats = query_stats.setdefault(fingerprint, {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "plan": None})
+        stats["count"] += 1
+        stats["total_ms"] += duration_ms
+        stats["max_ms"] = max(stats["max_ms"], duration_ms)
+        capture_plan = stats["plan"] is None
+        if capture_plan:
+            # Claim the capture so concurrent requests don't all run EXPLAIN
+            stats["plan"] = []
+    
+    if capture_plan and query.lstrip().split(None, 1)[0].upper() in ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE"):
+        try:
+            # The 4th column of EXPLAIN QUERY PLAN is the human readable step, e.g. 'SCAN AgentUsage'
+            plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", query_parameters or [])]
+        except sqlite3.Error as e:
+            plan = [f"Unable to capture plan: {e}"]
+        with query_stats_lock:
+            stats["plan"] = plan
+        logger.info(f"Query plan for {fingerprint}: {plan}")
+    
+    if duration_ms >= slow_query_ms:
+        logger.warning(f"Slow query ({duration_ms:.1f} ms, {parameters_shape(query_parameters)}): {fingerprint} | plan: {stats['plan']}")
+
+def slowest_queries(top_n: int = 10) -> List[dict]:
+    """Return the top_n statement fingerprints by total time spent"""
+    with query_stats_lock:
+        snapshot = [{"fingerprint": fingerprint, **stats, "plan": list(stats["plan"] or [])} for fingerprint, stats in query_stats.items()]
+    
+    for stats in snapshot:
+        stats["mean_ms"] = round(stats["total_ms"] / stats["count"], 3)
+        stats["total_ms"] = round(stats["total_ms"], 3)
+        stats["max_ms"] = round(stats["max_ms"], 3)
+    
+    return sorted(snapshot, key=lambda stats: stats["total_ms"], reverse=True)[:top_n]
+
+
+def to_epoch(date_time: datetime) -> int:
+    """Convert a (naive) datetime to the integer seconds stored in AgentEvent.TS"""
+    return int((date_time - EPOCH).total_seconds())
+
+def from_epoch(ts: int) -> datetime:
+    """Convert AgentEvent.TS back to a naive datetime"""
+    return EPOCH + timedelta(seconds=ts)
+
+def to_shift_day(shift_date: dt.date) -> int:
+    """Convert a shift date to the integer day number stored in AgentEvent.SHIFT_DAY"""
+    return (shift_date - EPOCH.date()).days
+
+def from_shift_day(shift_day: int) -> dt.date:
+    """Convert AgentEvent.SHIFT_DAY back to a date"""
+    return EPOCH.date() + timedelta(days=shift_day)
+
+def usage_query(agents: List[str], by_shift_day: bool = False) -> str:
+    """Build the query for the usage events of the given agents, in the order they were recorded.
+       Takes either a TS range (two epoch parameters) or a single SHIFT_DAY, followed by the agent names.
+       Returns the same columns as the AgentUsage view, but with integer TS/SHIFT_DAY so create_csv can skip string parsing.
+    """
+    placeholders = ','.join(['?'] * len(agents))
+    condition = "e.SHIFT_DAY = ?" if by_shift_day else "e.TS BETWEEN ? AND ?"
+    
+    return (
+        "SELECT a.NAME, a.EMAIL, e.TS, e.SHIFT_DAY, e.PREVIOUS_VALUE, e.NEW_VALUE "
+        "FROM AgentEvent e JOIN Agent a ON a.ID = e.AGENT_ID "
+        f"WHERE {condition} AND a.NAME IN ({placeholders}) "
+        "ORDER BY e.TS, e.rowid"
+    )
+
+
+def rollup_recurrence(start_date_time: datetime, end_date_time: datetime) -> str:
+    """Pick daily or weekly periods for a date range, with the same 14 shift threshold as create_csv"""
+    return "weekly" if (end_date_time - start_date_time).days >= 14 else "daily"
+
+def team_rollup(start_date_time: datetime, end_date_time: datetime, managers: Optional[List[str]] = None, recurrence: Optional[str] = None) -> List[dict]:
+    """Return total, average and at-target hours per manager's team (plus an org-wide row) for each day or week in the range.
+       managers defaults to every team in the teams_hierarchy.
+    """
+    
+    recurrence = recurrence or rollup_recurrence(start_date_time, end_date_time)
+    weekly = recurrence == "weekly"
+    
+    # Same targets as the charts: DESIRED_DAILY_AVAIL per day, or five days' worth per week
+    target_hours = DESIRED_DAILY_AVAIL * 5 if weekly else DESIRED_DAILY_AVAIL
+    
+    roster = [agent for manager, team in teams_hierarchy.items() if not managers or manager in managers for agent in team]
+    if not roster:
+        return []
+    
+    # 1970-01-01 was a Thursday, so (SHIFT_DAY + 3) % 7 is the number of days since Monday
+    period = "SHIFT_DAY - (SHIFT_DAY + 3) % 7" if weekly else "SHIFT_DAY"
+    sql_query = TEAM_ROLLUP_QUERY.format(roster=','.join(['?'] * len(roster)), period=period)
+    query_parameters = roster + [
+        to_epoch(start_date_time), to_epoch(end_date_time),
+        shifts_times['shift_start'] * 3600, MAX_DAILY_AVAIL * 3600, MAX_DAILY_AVAIL * 3600, MAX_DAILY_AVAIL * 3600, target_hours * 3600,
+    ]
+    
+    results = query_reports(sql_query, query_parameters, to_epoch(end_date_time)) or []
+    
+    rollup = []
+    for is_org, manager, period_day, agents, seconds, at_target in results:
+        period_start = from_shift_day(period_day)
+        rollup.append({
+            "manager": ORG_LABEL if is_org else manager,
+            # Weeks are labelled Monday --> Friday like the weekly charts
+            "period": f"{period_start} --> {period_start + timedelta(days=4)}" if weekly else str(period_start),
+            "agents": agents,
+            "total_hours": round(seconds / 3600, 2),
+            "average_hours": round(seconds / 3600 / agents, 2),
+            "at_target": at_target,
+            "target_hours": target_hours,
+        })
+    
+    return rollup
+
+
+def agent_set_hash(agents: List[str]) -> str:
+    """Return a canonical hash for a set of agents so the same agents in any order (or repeated) hash the same"""
+    canonical = ','.join(sorted(set(agents)))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def load_secret_key() -> str:
+    """Return the key used to sign session cookies.
+       Uses the ROBOT_TRACKER_SECRET_KEY environment variable if set, otherwise the key in SECRET_KEY_FILE (created on first run).
+    """
+    key = os.environ.get('ROBOT_TRACKER_SECRET_KEY')
+    if key:
+        return key
+    
+    if not os.path.exists(SECRET_KEY_FILE):
+        # Write the new key to a temp file then hard link it into place.
+        # The link fails if another worker got there first, so every process ends up with the same key.
+        temp_file = f"{SECRET_KEY_FILE}.{os.getpid()}"
+        with open(temp_file, 'w', encoding='utf-8') as file:
+            file.write(secrets.token_hex(32))
+        os.chmod(temp_file, 0o600)
+        try:
+            os.link(temp_file, SECRET_KEY_FILE)
+            logger.info(f"New session signing key saved to {SECRET_KEY_FILE}")
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_file)
+    
+    with open(SECRET_KEY_FILE, 'r', encoding='utf-8') as file:
+        return file.read().strip()
+
+
+def generate_user_id():
     # Generate a random string of a specific length
     # token_hex() represents each byte of the specified byte length with 2 hex characters, so need to divide by two.
-    user_id = app.secret_key = secrets.token_hex(USER_ID_LENGTH // 2)  
+    user_id = secrets.token_hex(USER_ID_LENGTH // 2)  
     return user_id
 
-def create_graph(csv_file_path, agents, recurrence):
-    """Create a graph of the agent's availability over time and save it as an image in the user's temp folder"""
+def config_version() -> str:
+    """A short hash of the config the homepage is built from, so cached copies can tell when it has changed"""
+    config = json.dumps({"teams": teams_hierarchy, "valid_domains": valid_domains}, sort_keys=True)
+    return hashlib.sha256(config.encode('utf-8')).hexdigest()[:16]
+
+@functools.lru_cache(maxsize=4096)
+def hash_file(path: str, mtime_ns: int, size: int) -> str:
+    """SHA-256 of a file's contents. Cached by modification time and size, so a re-rendered file is hashed again."""
+    with open(path, 'rb') as chart_file:
+        return hashlib.sha256(chart_file.read()).hexdigest()
+
+def chart_etag(chart_path: str) -> str:
+    """Strong ETag for a chart image: it only changes when the image itself does"""
+    stat = os.stat(chart_path)
+    return hash_file(chart_path, stat.st_mtime_ns, stat.st_size)[:32]
+
+def chart_period_closed(chart_path: str) -> bool:
+    """True if the chart is for a day/week whose last shift has finished, so its data can't change any more.
+       The summary chart (and anything else without a date in its name) counts as open.
+    """
+    label = os.path.basename(chart_path)[len("graph_"):-len(".png")]
+    try:
+        last_date = dt.date.fromisoformat(label.split("_")[-1])
+    except ValueError:
+        return False
+    
+    # The last shift of the period runs until shift_start + 1 the next morning (see record_agent_state)
+    shift_end = datetime.combine(last_date + timedelta(days=1), time(shifts_times['shift_start'] + 1))
+    return datetime.now() >= shift_end
+
+def period_label(period, weekly: bool) -> str:
+    """The string used for a period in chart file names and detail links, e.g. 2025-02-20 or 2025-02-17_2025-02-23"""
+    return str(period).replace("/", "_") if weekly else str(period)
+
+def chart_periods(csv_file_path, recurrence) -> List[str]:
+    """Return the labels of every period (day or week) in a report CSV, oldest first"""
+    shift_dates = pd.to_datetime(pd.read_csv(csv_file_path, usecols=['Shift Date'])['Shift Date'])
+    periods = shift_dates.dt.to_period('W').unique() if recurrence == "weekly" else shift_dates.dt.date.unique()
+    return [period_label(period, recurrence == "weekly") for period in sorted(periods)]
+
+def summary_periods(chart_paths, csv_file_path, recurrence) -> List[str]:
+    """If create_graph summarized the report, return the periods that can be charted on demand, else an empty list"""
+    if len(chart_paths) == 1 and os.path.basename(chart_paths[0]) == SUMMARY_CHART_NAME:
+        return chart_periods(csv_file_path, recurrence)
+    return []
+
+def create_summary_graph(df_periods, agents, weekly, total_time_desired, user_folder) -> str:
+    """Render every agent and period as one heatmap (agents down the side, periods along the bottom) and return its path"""
+    
+    column = 'Week' if weekly else 'Shift Date'
+    
+    # One cell per agent per period, with agents who have no data shown as 0 hours
+    pivot = df_periods.pivot_table(index='Name', columns=column, values='Time Logged In', aggfunc='sum', fill_value=0)
+    pivot = pivot.reindex(index=sorted(set(agents) | set(pivot.index)), fill_value=0)
+    labels = [period_label(period, weekly) for period in pivot.columns]
+    
+    # Grow the figure with the data, within reason
+    fig = Figure(figsize=(min(max(10, 0.6 * len(labels) + 3), 30), min(max(4, 0.35 * len(pivot.index) + 2), 30)))
+    ax = fig.subplots()
+    
+    # Red below the desired hours, green above
+    norm = TwoSlopeNorm(vmin=0, vcenter=total_time_desired, vmax=max(total_time_desired + 1, pivot.values.max()))
+    image = ax.imshow(pivot.values, aspect='auto', cmap='RdYlGn', norm=norm)
+    fig.colorbar(image, ax=ax, label='Total Hours Available')
+    
+    # Write the hours in each cell while they're still readable
+    if pivot.size <= 400:
+        for row, agent in enumerate(pivot.index):
+            for col in range(len(labels)):
+                ax.text(col, row, f"{pivot.values[row, col]:.1f}", ha='center', va='center', fontsize=8)
+    
+    ax.set_title(f'Hours Available from {labels[0]} to {labels[-1]}', fontsize=14)
+    ax.set_xlabel('Week' if weekly else 'Shift Date', fontsize=12)
+    ax.set_ylabel('Agent', fontsize=12)
+    ax.set_xticks(range(len(labels)))
+    ax.set_xticklabels(labels, rotation=75, ha='right')
+    ax.set_yticks(range(len(pivot.index)))
+    ax.set_yticklabels(pivot.index)
+    fig.tight_layout()
+    
+    graph_path = os.path.join(user_folder, SUMMARY_CHART_NAME)
+    fig.savefig(graph_path)
+    logger.info(f"Summary graph saved to {graph_path}")
+    
+    return graph_path
+
+def create_graph(csv_file_path, agents, recurrence, only_period=None, summary_threshold=SUMMARY_CHART_THRESHOLD):
+    """Create a graph of the agent's availability over time and save it as an image in the user's temp folder.
+       If there are more than summary_threshold periods, one summary heatmap is created instead (None to always chart every period).
+       only_period (a period_label) creates just that period's chart, for viewing a single period of a summarized report.
+    """
     # Check for weekly flag
     if recurrence == "daily":
         weekly = False
@@ -196,7 +560,15 @@ def create_graph(csv_file_path, agents, recurrence):
     # Create a set of all agents
     all_agents = set(agents)
 
-    for period in df_daily['Shift Date'].unique() if not weekly else df_weekly['Week'].unique():
+    periods = df_daily['Shift Date'].unique() if not weekly else df_weekly['Week'].unique()
+    
+    if only_period:
+        periods = [period for period in periods if period_label(period, weekly) == only_period]
+    elif summary_threshold is not None and len(periods) > summary_threshold:
+        logger.info(f"{len(periods)} periods, creating a summary graph")
+        return [create_summary_graph(df_weekly if weekly else df_daily, agents, weekly, total_time_desired, user_folder)]
+    
+    for period in periods:
         if weekly:
             # Period string manipulation for weekly reports
             period_str = str(period).replace("/", "_")  # Replace '/' with '_'
@@ -230,30 +602,33 @@ def create_graph(csv_file_path, agents, recurrence):
             df_period = pd.concat([df_period, missing_agent_df], ignore_index=True)
       
         # Create the plot
-        plt.figure(figsize=(10, 6))  # Set the figure size
-        plt.bar(df_period['Name'], df_period['Time Logged In'], color='skyblue')
+        # (each chart gets its own Figure, so requests on different threads can't draw on each other's charts)
+        fig = Figure(figsize=(10, 6))  # Set the figure size
+        ax = fig.subplots()
+        ax.bar(df_period['Name'], df_period['Time Logged In'], color='skyblue')
 
         # Add titles and labels
         title = f'Hours Available from {start_date} to {end_date}' if weekly else f'Hours Available from {period}'
-        plt.title(title, fontsize=14)
-        plt.xlabel('Agent', fontsize=12)
-        plt.ylabel('Total Hours Available', fontsize=12)
-        plt.xticks(rotation=75, ha='right')  # Rotate agent names for readability
-        plt.axhline(y=total_time_desired, color='r', linestyle='-', label="Desired Hours")  # Add a horizontal line for base case
+        ax.set_title(title, fontsize=14)
+        ax.set_xlabel('Agent', fontsize=12)
+        ax.set_ylabel('Total Hours Available', fontsize=12)
+        for label in ax.get_xticklabels():  # Rotate agent names for readability
+            label.set_rotation(75)
+            label.set_horizontalalignment('right')
+        ax.axhline(y=total_time_desired, color='r', linestyle='-', label="Desired Hours")  # Add a horizontal line for base case
 
         # Save the plot as an image
-        plt.tight_layout()  # Ensure the layout is clean
+        fig.tight_layout()  # Ensure the layout is clean
         graph_path = os.path.join(user_folder, f"graph_{period_str}.png")
         logger.info(f"Saving to graph path {graph_path}")
         try:
-            plt.savefig(graph_path)  # Save the graph with the period in the filename
+            fig.savefig(graph_path)  # Save the graph with the period in the filename
             chart_paths.append(graph_path)
             logger.info(f"Graph saved to {graph_path}")
             logger.info("Adding graph to chart_paths list")
         except Exception as e:
             logger.error(f"Error saving graph to {graph_path}")
             logger.error(f"Error: {e}")
-        plt.close() 
     
     return chart_paths
     
@@ -317,12 +692,18 @@ def create_csv(results, user_id=None, email=None):
                 int(row[5]),
             )
             
-            # Convert date/time strings to datetime objects
-            actual_date_time = datetime.strptime(str(actual_date_time), r"%Y-%m-%d %H:%M:%S")
+            # Convert the timestamps to datetime objects.
+            # Rows from AgentEvent have integer timestamps, rows from the AgentUsage view (or older exports) have strings.
+            if isinstance(actual_date_time, int):
+                actual_date_time = from_epoch(actual_date_time)
+            else:
+                actual_date_time = datetime.strptime(str(actual_date_time), r"%Y-%m-%d %H:%M:%S")
             
             # Clense the data that was recorded before the concept of shift_changes (shift date = null)
-            # Note we could just do this manually in the database which I will probably do in the future, so below will be redundant.
-            if not shift_date:
+            # Note the AgentEvent migration fills these in, so this only applies to string rows.
+            if isinstance(shift_date, int):
+                shift_date = from_shift_day(shift_date)
+            elif not shift_date:
                 if actual_date_time.hour < shifts_times['shift_start']:
                     shift_date = actual_date_time.date() - timedelta(days=1)
                 else:
@@ -413,6 +794,70 @@ def create_csv(results, user_id=None, email=None):
 
     return csv_file_path, filename, recurrence
 
+def create_export(csv_file_path, export_format) -> Optional[str]:
+    """Convert a report CSV to Parquet or Arrow IPC (with typed timestamp/date/duration columns) and return its path.
+       The CSV is converted a block at a time, and the Arrow file is uncompressed so readers can memory-map it.
+       Returns the CSV itself for "csv", and None if pyarrow isn't installed.
+    """
+    
+    if export_format == "csv":
+        return csv_file_path
+    
+    if pa is None:
+        logger.error(f"pyarrow is not installed, can't export {export_format}")
+        return None
+    
+    # Only convert each report once
+    export_path = str(Path(csv_file_path).with_suffix(f".{export_format}"))
+    if os.path.exists(export_path):
+        return export_path
+    
+    schema = pa.schema([
+        ("Name", pa.string()),
+        ("Actual Date", pa.timestamp('s')),
+        ("Shift Date", pa.date32()),
+        ("Previous Value", pa.int8()),
+        ("New Value", pa.int8()),
+        ("Time Logged In", pa.duration('s')),
+    ])
+    
+    # Time Logged In is written as H:MM:SS, which Arrow can't parse as a duration, so read it as text and convert below
+    column_types = {field.name: field.type for field in schema}
+    column_types["Time Logged In"] = pa.string()
+    reader = pa_csv.open_csv(
+        csv_file_path,
+        read_options=pa_csv.ReadOptions(block_size=EXPORT_BLOCK_SIZE),
+        convert_options=pa_csv.ConvertOptions(column_types=column_types, timestamp_parsers=[r"%Y-%m-%d %H:%M:%S"]),
+    )
+    
+    # Write to a temp file then rename, so a half written export is never served
+    # (each export gets its own temp file, so two requests converting the same report can't write into each other's)
+    temp_fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(export_path), suffix=f".{export_format}.tmp")
+    os.close(temp_fd)
+    
+    rows = 0
+    try:
+        if export_format == "parquet":
+            writer = pq.ParquetWriter(temp_path, schema)
+        else:
+            writer = pa.ipc.new_file(temp_path, schema)
+        
+        with writer:
+            for batch in reader:
+                hours, minutes, seconds = (pc.cast(pc.list_element(pc.split_pattern(batch.column("Time Logged In"), ":"), i), pa.int64()) for i in range(3))
+                total_seconds = pc.add(pc.add(pc.multiply(hours, 3600), pc.multiply(minutes, 60)), seconds)
+                columns = batch.columns[:-1] + [total_seconds.cast(pa.duration('s'))]
+                writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=schema))
+                rows += batch.num_rows
+    except Exception:
+        os.remove(temp_path)
+        raise
+    
+    os.replace(temp_path, export_path)
+    logger.info(f"{export_format.title()} export of {rows} rows saved: {export_path}")
+    
+    return export_path
+
 def create_datetime_object(request):
     """Convert date and time strings to datetime objects in the form YYYY-MM-DD HH:MM:SS"""
 
@@ -449,12 +894,16 @@ def redis_connect():
     
     return r
 
-def redis_add_to_cache(r, user_id, csv_file_path):
-    """Add the user's results to the Redis cache"""
-    # Add the file path to the cache against the user's session ID
-    r.set(user_id, csv_file_path)
-    # Set an expiry time of 1 hour (3600 seconds) for the cache
-    r.expire(user_id, CACHE_TTL)
+def agents_cache_key(user_id: str) -> str:
+    """Key the agents of the user's last report by their session ID (the cookie only holds the ID)"""
+    return f"agents:{user_id}"
+
+def redis_add_to_cache(r, user_id, csv_file_path, agents: List[str]):
+    """Add the user's results, and the agents they were built for, to the Redis cache"""
+    # Add the file path to the cache against the user's session ID, with an expiry time of 1 hour (3600 seconds)
+    r.set(user_id, csv_file_path, ex=CACHE_TTL)
+    # Keep the agent list here rather than in the session cookie, which browsers cap at 4KB
+    r.set(agents_cache_key(user_id), json.dumps(agents), ex=CACHE_TTL)
     logger.info(f"Results added to cache for user {user_id}")
 
 def redis_pull_from_cache(r, user_id):
@@ -463,4 +912,66 @@ def redis_pull_from_cache(r, user_id):
     csv_file_path = r.get(user_id)
     
     # Return the file path with it's unique timestamp so we can access the correct file in download_csv
-    return csv_file_path
\ No newline at end of file
+    return csv_file_path
+
+def redis_pull_agents(r, user_id) -> Optional[List[str]]:
+    """Pull the agents of the user's last report from the Redis cache, or None if it has expired"""
+    agents = r.get(agents_cache_key(user_id))
+    return json.loads(agents) if agents else None
+
+def report_cache_key(start_date_time: datetime, end_date_time: datetime, agents: List[str]) -> str:
+    """Key a built report by its exact date range and agent set (in any order)"""
+    return f"report:{to_epoch(start_date_time)}:{to_epoch(end_date_time)}:{agent_set_hash(agents)}"
+
+def redis_add_report(r, key: str, csv_file_path: str, chart_paths: List[str], recurrence: str) -> None:
+    """Cache the paths of a built report's CSV and charts so /filter can serve it without touching the database"""
+    report = {"csv_file_path": csv_file_path, "chart_paths": chart_paths, "recurrence": recurrence}
+    r.set(key, json.dumps(report), ex=REPORT_CACHE_TTL)
+
+def redis_pull_report(r, key: str) -> Optional[dict]:
+    """Return a cached report, or None if there isn't one or its files have since been removed"""
+    cached = r.get(key)
+    if not cached:
+        return None
+    
+    report = json.loads(cached)
+    if not all(os.path.exists(path) for path in [report["csv_file_path"]] + report["chart_paths"]):
+        logger.info(f"Cached report {key} is missing files, rebuilding")
+        return None
+    
+    return report
+
+def publish_changes(changes: List[dict]) -> None:
+    """Publish recorded state changes to the live dashboard channel (best effort, the database is the source of truth)"""
+    if not changes:
+        return
+    
+    r = redis_connect()
+    if not r:
+        logger.error("Redis not available, live dashboard won't receive these changes")
+        return
+    
+    try:
+        # Send them all in one round trip
+        pipe = r.pipeline(transaction=False)
+        for change in changes:
+            pipe.publish(CHANGES_CHANNEL, json.dumps(change))
+        pipe.execute()
+        logger.info(f"Published {len(changes)} state change(s) to {CHANGES_CHANNEL}")
+    except redis.exceptions.RedisError as e:
+        logger.error(f"Error publishing state changes: {e}")
+
+def latest_agent_states(since: datetime) -> List[dict]:
+    """Return each agent's most recent state recorded since the given time (for the live dashboard's initial view)"""
+    
+    # SQLite returns the other columns from the row holding MAX(e.TS)
+    sql_query = (
+        "SELECT a.NAME, a.MANAGER, e.NEW_VALUE, MAX(e.TS) FROM AgentEvent e "
+        "JOIN Agent a ON a.ID = e.AGENT_ID WHERE e.TS >= ? GROUP BY e.AGENT_ID ORDER BY a.MANAGER, a.NAME"
+    )
+    results = connect_to_database(sql_query, [to_epoch(since)]) or []
+    
+    return [
+        {"name": name, "manager": manager, "available": int(new_value), "timestamp": from_epoch(ts).strftime(r"%Y-%m-%d %H:%M:%S")}
+        for name, manager, new_value, ts in results
+    ]
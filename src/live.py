@@ -0,0 +1,83 @@
+# Standard library imports
+import time
+import queue
+import threading
+
+# Third-party imports
+import redis.exceptions
+
+# Local application imports
+import common
+
+# Constants
+CLIENT_QUEUE_SIZE = 100  # Changes buffered per browser before we treat it as too slow and drop it
+RECONNECT_DELAY = 5  # Seconds to wait before re-subscribing after losing Redis
+
+# Set up a global custom logger object for this script
+logger = common.setup_custom_logger("live")
+
+
+class ChangeBroadcaster:
+    """Fans the Redis change channel out to every connected browser in this process.
+       There's one Redis subscription per process however many browsers are watching,
+       and each browser just reads from its own in-memory queue.
+    """
+
+    def __init__(self):
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self) -> queue.Queue:
+        """Register a new browser and return the queue its changes will arrive on"""
+        client = queue.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        with self.lock:
+            self.clients.add(client)
+            # Start listening to Redis the first time someone connects
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.listen, name="live-change-listener", daemon=True)
+                self.thread.start()
+        return client
+
+    def unsubscribe(self, client: queue.Queue) -> None:
+        with self.lock:
+            self.clients.discard(client)
+
+    def is_subscribed(self, client: queue.Queue) -> bool:
+        with self.lock:
+            return client in self.clients
+
+    def broadcast(self, data: str) -> None:
+        """Hand a change to every browser, dropping any that have stopped reading"""
+        with self.lock:
+            clients = list(self.clients)
+
+        for client in clients:
+            try:
+                client.put_nowait(data)
+            except queue.Full:
+                logger.info("Dropping a live dashboard client that has fallen behind")
+                self.unsubscribe(client)
+
+    def listen(self) -> None:
+        """Subscribe to the change channel and broadcast every message, reconnecting if Redis goes away"""
+        while True:
+            r = common.redis_connect()
+            if not r:
+                time.sleep(RECONNECT_DELAY)
+                continue
+
+            try:
+                pubsub = r.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(common.CHANGES_CHANNEL)
+                logger.info(f"Subscribed to {common.CHANGES_CHANNEL}")
+
+                for message in pubsub.listen():
+                    self.broadcast(message['data'].decode('utf-8'))
+            except redis.exceptions.RedisError as e:
+                logger.error(f"Lost subscription to {common.CHANGES_CHANNEL}: {e}")
+                time.sleep(RECONNECT_DELAY)
+
+
+# One broadcaster per process
+broadcaster = ChangeBroadcaster()
@@ -0,0 +1,379 @@
+# Standard library imports
+import os
+import re
+import json
+import time
+import random
+import shutil
+import sqlite3
+import logging
+import argparse
+import datetime
+import tempfile
+import threading
+import statistics
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Third-party imports
+import requests
+from werkzeug.serving import make_server
+
+# Local application imports
+import common
+import benchmark
+import utilities
+import synthetic_data
+import benchmark_email
+import robot_usage_tracker
+
+# Constants
+RESULTS_FOLDER = 'benchmark_results'
+TEMP_FOLDER = os.path.join('static', 'temp')
+DEFAULT_MIX = "homepage=3,filter=4,teams=1,download=2"
+ENDPOINTS = ("homepage", "filter", "teams", "download")
+REQUEST_TIMEOUT = 120
+FRESHDESK_PAGE_SIZE = 100
+
+# Set up a global custom logger object for this script
+logger = common.setup_custom_logger("load_test")
+
+
+class StubFreshdeskHandler(BaseHTTPRequestHandler):
+    """Serves the Freshdesk agents API for the synthetic roster, with each agent flipping availability now and again"""
+
+    agents = []
+    states = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        per_page = int(query.get('per_page', [FRESHDESK_PAGE_SIZE])[0])
+        page = int(query.get('page', [1])[0])
+
+        with self.lock:
+            for agent in self.agents:
+                if random.random() < 0.1:
+                    self.states[agent] = not self.states.get(agent, False)
+            page_agents = self.agents[(page - 1) * per_page:page * per_page]
+            body = [{"available": self.states.get(agent, False), "contact": {"name": agent, "email": f"{agent.lower()}@outlook.com"}} for agent in page_agents]
+
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        # Keep the stub quiet, the app's own logging is enough
+        pass
+
+
+def start_in_thread(server, name: str) -> None:
+    """Run an HTTP server's serve_forever in a daemon thread"""
+    threading.Thread(target=server.serve_forever, name=name, daemon=True).start()
+
+
+def start_stub_freshdesk(agents: list):
+    """Start the stub agents API on a free local port and point the poller at it"""
+    StubFreshdeskHandler.agents = agents
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubFreshdeskHandler)
+    start_in_thread(server, "stub-freshdesk")
+
+    robot_usage_tracker.FRESHDESK_URL = f"http://127.0.0.1:{server.server_port}/api/v2/agents"
+    robot_usage_tracker.API_KEY = robot_usage_tracker.API_KEY or "load-test"
+    logger.info(f"Stub Freshdesk API listening on {robot_usage_tracker.FRESHDESK_URL}")
+    return server
+
+
+def run_every(interval: float, job, stop: threading.Event, name: str) -> None:
+    """Run job every interval seconds in a daemon thread until stop is set (interval 0 = never)"""
+    if not interval:
+        return
+
+    def loop():
+        while not stop.wait(interval):
+            try:
+                job()
+            except Exception as e:
+                logger.error(f"Background {name} run failed: {e}")
+
+    threading.Thread(target=loop, name=name, daemon=True).start()
+
+
+def poll_once() -> None:
+    """One poller run against the stub Freshdesk API, writing to the load test database like the real cron job would"""
+    conn = sqlite3.connect(common.DATABASE_NAME, timeout=30)
+    robot_usage_tracker.send_requests(conn.cursor(), conn, robot_usage_tracker.build_headers(), datetime.datetime.now())
+
+
+def parse_mix(value: str) -> dict:
+    """Turn "homepage=3,filter=4" into {"homepage": 3.0, "filter": 4.0}"""
+    mix = {}
+    for part in value.split(','):
+        endpoint, weight = part.split('=')
+        if endpoint not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"Unknown endpoint {endpoint!r}, expected one of {', '.join(ENDPOINTS)}")
+        mix[endpoint] = float(weight)
+    return mix
+
+
+class SimulatedUser:
+    """One browser session: picks its next request from the mix, then waits a (random) think time before the next"""
+
+    def __init__(self, base_url: str, roster: dict, ranges: list, args, record, rng: random.Random):
+        self.base_url = base_url
+        self.roster = roster
+        self.ranges = ranges
+        self.args = args
+        self.record = record
+        self.rng = rng
+        self.session = requests.Session()
+        self.user_id = None
+        self.has_report = False
+
+    def request(self, endpoint: str, method: str, path: str, **kwargs):
+        """Send a request and record its latency and status against the endpoint"""
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, timeout=REQUEST_TIMEOUT, **kwargs)
+            self.record(endpoint, time.perf_counter() - start, response.status_code)
+            return response
+        except requests.RequestException as e:
+            self.record(endpoint, time.perf_counter() - start, None)
+            logger.error(f"{endpoint} request failed: {e}")
+            return None
+
+    def homepage(self) -> None:
+        response = self.request("homepage", "GET", "/")
+        if response is not None and response.ok:
+            match = re.search(r'action="/filter_([^"]+)"', response.text)
+            self.user_id = match.group(1) if match else self.user_id
+
+    def report_form(self, teams_mode: bool) -> dict:
+        """A homepage submission: a preset date range and either a whole team or a handful of agents"""
+        start, end = self.rng.choice(self.ranges)
+        teams = list(self.roster.values())
+        if self.rng.random() < 0.7:
+            agents = self.rng.choice(teams)
+        else:
+            everyone = [agent for team in teams for agent in team]
+            agents = self.rng.sample(everyone, k=min(len(everyone), self.rng.randint(1, 10)))
+
+        form = {
+            'startdate': start.date().isoformat(), 'enddate': end.date().isoformat(),
+            'starttime': start.strftime('%H:%M'), 'endtime': end.strftime('%H:%M'), 'agent': agents,
+        }
+        if teams_mode:
+            form['mode'] = 'teams'
+        return form
+
+    def filter(self, teams_mode: bool = False) -> None:
+        endpoint = "teams" if teams_mode else "filter"
+        response = self.request(endpoint, "POST", f"/filter_{self.user_id}", data=self.report_form(teams_mode))
+        if not teams_mode and response is not None and response.ok:
+            self.has_report = True
+
+    def download(self) -> None:
+        export_format = self.rng.choice(self.args.download_formats)
+        self.request("download", "GET", f"/download_csv?format={export_format}")
+
+    def run(self, deadline: float) -> None:
+        endpoints = list(self.args.mix)
+        weights = [self.args.mix[endpoint] for endpoint in endpoints]
+
+        # Everyone lands on the homepage first (that's where the session and user ID come from)
+        self.homepage()
+
+        while time.perf_counter() < deadline:
+            # Think time between clicks, exponentially distributed around the mean
+            if self.args.think_time:
+                time.sleep(min(self.rng.expovariate(1 / self.args.think_time), max(0, deadline - time.perf_counter())))
+                if time.perf_counter() >= deadline:
+                    break
+
+            endpoint = self.rng.choices(endpoints, weights)[0]
+            if endpoint == "homepage":
+                self.homepage()
+            elif endpoint == "teams":
+                self.filter(teams_mode=True)
+            elif endpoint == "download" and self.has_report:
+                self.download()
+            else:
+                # A download needs a report first, as it would in the browser
+                self.filter()
+
+        self.session.close()
+
+
+def summarize(samples: dict, seconds: float) -> dict:
+    """Latency percentiles (ms), throughput and error rates per endpoint, plus an overall line"""
+
+    def stats(entries: list) -> dict:
+        durations = sorted(duration for duration, _ in entries)
+        statuses = [status for _, status in entries]
+        errors = sum(1 for status in statuses if status is None or (status >= 400 and status != 429))
+        refused = statuses.count(429)
+        # quantiles needs at least two data points
+        percentiles = statistics.quantiles(durations, n=100, method='inclusive') if len(durations) > 1 else durations * 99
+        return {
+            "requests": len(entries),
+            "throughput": round(len(entries) / seconds, 2),
+            "p50_ms": round(percentiles[49] * 1000, 1),
+            "p95_ms": round(percentiles[94] * 1000, 1),
+            "p99_ms": round(percentiles[98] * 1000, 1),
+            "max_ms": round(durations[-1] * 1000, 1),
+            "errors": errors,
+            "error_rate": round(errors / len(entries), 4),
+            "refused": refused,
+        }
+
+    summary = {endpoint: stats(entries) for endpoint, entries in samples.items() if entries}
+    everything = [entry for entries in samples.values() for entry in entries]
+    if everything:
+        summary["overall"] = stats(everything)
+    return summary
+
+
+def print_summary(summary: dict) -> None:
+    print(f"{'endpoint':<10} {'requests':>8} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7} {'429s':>6}")
+    for endpoint, result in summary.items():
+        print(
+            f"{endpoint:<10} {result['requests']:>8} {result['throughput']:>8.2f} {result['p50_ms']:>9.1f} "
+            f"{result['p95_ms']:>9.1f} {result['p99_ms']:>9.1f} {result['errors']:>7} {result['refused']:>6}"
+        )
+
+
+def run_load_test(args) -> dict:
+    """Start the app and its stand-ins against a synthetic database, drive the simulated users and return the per-endpoint results"""
+
+    work_folder = tempfile.mkdtemp(prefix="robot_load_test_")
+    database_name = os.path.join(work_folder, "RobotTracker.db")
+
+    roster = synthetic_data.generate(
+        database_name, agents=args.agents, managers=args.managers, days=args.days,
+        state_changes_per_day=args.state_changes, subscribers=args.subscribers, seed=args.seed
+    )
+
+    # Point the application (and the poller) at the synthetic database and roster
+    common.DATABASE_NAME = database_name
+    common.teams_hierarchy = roster
+    robot_usage_tracker.teams_hierarchy = roster
+
+    redis_backend = benchmark.use_fakeredis_if_needed()
+    if not redis_backend:
+        raise RuntimeError("No Redis server and fakeredis isn't installed, the app can't serve reports without one")
+
+    # Reports and charts are written under static/temp, so only clean up the folders this run creates
+    os.makedirs(TEMP_FOLDER, exist_ok=True)
+    existing_temp = set(os.listdir(TEMP_FOLDER))
+
+    stop = threading.Event()
+
+    # Email goes to a local sink, the poller to the stub API
+    smtp_controller, smtp_handler = benchmark_email.start_stub_smtp(port=args.smtp_port)
+    utilities.SMTP_SERVER, utilities.SMTP_PORT = benchmark_email.STUB_SMTP_HOST, args.smtp_port
+    freshdesk = start_stub_freshdesk([agent for team in roster.values() for agent in team])
+
+    # Import the app only now, so it sets up against the synthetic database
+    import app as web_app
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', args.port, web_app.app, threaded=True)
+    start_in_thread(server, "load-test-app")
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    logger.info(f"App listening on {base_url} (Redis: {redis_backend})")
+
+    today = datetime.date.today()
+    if args.prewarm:
+        utilities.prewarm_reports(today)
+    ranges = list(utilities.preset_ranges(today).values())
+
+    # Background writers and jobs the real deployment runs alongside the web traffic
+    run_every(args.poll_interval, poll_once, stop, "poller")
+    run_every(args.email_interval, lambda: utilities.email_main('daily'), stop, "email-job")
+
+    samples = {endpoint: [] for endpoint in ENDPOINTS}
+    samples_lock = threading.Lock()
+
+    def record(endpoint, duration, status):
+        with samples_lock:
+            samples[endpoint].append((duration, status))
+
+    rng = random.Random(args.seed)
+    users = []
+    start = time.perf_counter()
+    deadline = start + args.ramp_up + args.duration
+    for number in range(args.users):
+        user = SimulatedUser(base_url, roster, ranges, args, record, random.Random(rng.random()))
+        thread = threading.Thread(target=user.run, args=(deadline,), name=f"user-{number}", daemon=True)
+        users.append(thread)
+        thread.start()
+        # Spread the users' arrival over the ramp-up period
+        if args.ramp_up:
+            time.sleep(args.ramp_up / args.users)
+
+    for thread in users:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    server.shutdown()
+    freshdesk.shutdown()
+    smtp_controller.stop()
+
+    if not args.keep_files:
+        for folder in set(os.listdir(TEMP_FOLDER)) - existing_temp:
+            shutil.rmtree(os.path.join(TEMP_FOLDER, folder), ignore_errors=True)
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    return {
+        "seconds": round(elapsed, 2),
+        "redis": redis_backend,
+        "emails_sent": smtp_handler.received,
+        "endpoints": summarize(samples, elapsed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the web app with many concurrent simulated users against local stand-ins")
+    parser.add_argument("--users", type=int, default=20, help="Concurrent simulated sessions")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to run after ramp-up")
+    parser.add_argument("--ramp-up", type=float, default=5, help="Seconds over which the users arrive")
+    parser.add_argument("--think-time", type=float, default=1, help="Mean seconds between a user's requests (0 = none)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"Relative weights of {', '.join(ENDPOINTS)} (default {DEFAULT_MIX})")
+    parser.add_argument("--download-formats", type=lambda value: value.split(','), default=["csv"], help="Formats to download, e.g. csv,parquet")
+    parser.add_argument("--prewarm", action="store_true", help="Pre-warm the preset ranges before the run, as the scheduler would")
+    parser.add_argument("--poll-interval", type=float, default=30, help="Seconds between poller runs against the stub Freshdesk API (0 = off)")
+    parser.add_argument("--email-interval", type=float, default=0, help="Seconds between runs of the daily email job (0 = off)")
+    parser.add_argument("--port", type=int, default=0, help="Port for the app (defaults to any free port)")
+    parser.add_argument("--smtp-port", type=int, default=benchmark_email.STUB_SMTP_PORT)
+    parser.add_argument("--agents", type=int, default=20)
+    parser.add_argument("--managers", type=int, default=2)
+    parser.add_argument("--days", type=int, default=120)
+    parser.add_argument("--state-changes", type=float, default=6, help="Average state changes per agent per shift")
+    parser.add_argument("--subscribers", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep-files", action="store_true", help="Keep the synthetic database and generated reports")
+    parser.add_argument("--output", help="Where to write the JSON results (defaults to benchmark_results/load_<timestamp>.json)")
+    args = parser.parse_args()
+
+    results = {
+        "metadata": {
+            "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+            "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+        },
+        **run_load_test(args),
+    }
+
+    print_summary(results["endpoints"])
+
+    output = args.output or os.path.join(RESULTS_FOLDER, f"load_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as results_file:
+        json.dump(results, results_file, indent=2)
+    logger.info(f"Load test results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+# Standard library imports
+import os
+import json
+import time
+import bisect
+import tempfile
+import functools
+import threading
+from contextlib import contextmanager
+
+# Optional: only available on Unix, where the poller runs from cron and runs can overlap
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Constants
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+BYTE_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 104857600, 1073741824)
+SNAPSHOT_FOLDER = 'metrics'  # Every process (web workers, the poller, the scheduler) leaves its metrics here for /metrics to pick up
+SNAPSHOT_INTERVAL = 5  # Seconds between a web worker's saves, so most requests don't touch the snapshot file
+
+
+class Histogram:
+    """A Prometheus-style histogram with a single 'stage' label.
+       Observing is a bisect plus a few additions under a lock, so it's cheap enough to leave on in production.
+    """
+
+    def __init__(self, name: str, help_text: str, buckets: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # stage -> {"buckets": per-bucket counts (not cumulative, last slot is +Inf), "sum": float, "count": int}
+        self.stages = {}
+
+    def observe(self, stage: str, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            data = self.stages.get(stage)
+            if data is None:
+                data = self.stages[stage] = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            data["buckets"][index] += 1
+            data["sum"] += value
+            data["count"] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {stage: {"buckets": list(data["buckets"]), "sum": data["sum"], "count": data["count"]} for stage, data in self.stages.items()}
+
+    def drain(self) -> dict:
+        """Return the counts and start again from zero (used when handing them over to a snapshot file)"""
+        with self.lock:
+            stages, self.stages = self.stages, {}
+        return stages
+
+    def render(self, stages: dict) -> list:
+        """Return the exposition lines for this histogram, given its {stage: data} counts from the snapshot files"""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for stage, data in sorted(stages.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), data["buckets"]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{stage="{stage}"}} {data["sum"]}')
+            lines.append(f'{self.name}_count{{stage="{stage}"}} {data["count"]}')
+        return lines
+
+
+def merge_stages(into: dict, stages: dict) -> None:
+    """Add one set of {stage: data} counts to another, bucket by bucket"""
+    for stage, data in stages.items():
+        existing = into.get(stage)
+        if existing is None:
+            into[stage] = {"buckets": list(data["buckets"]), "sum": data["sum"], "count": data["count"]}
+        else:
+            existing["buckets"] = [a + b for a, b in zip(existing["buckets"], data["buckets"])]
+            existing["sum"] += data["sum"]
+            existing["count"] += data["count"]
+
+
+# Registry
+stage_duration = Histogram("robot_stage_duration_seconds", "Time spent in each pipeline stage.", DURATION_BUCKETS)
+stage_rows = Histogram("robot_stage_rows", "Rows handled by each pipeline stage.", ROW_BUCKETS)
+stage_bytes = Histogram("robot_stage_bytes", "Bytes produced by each pipeline stage.", BYTE_BUCKETS)
+HISTOGRAMS = (stage_duration, stage_rows, stage_bytes)
+last_saved = time.monotonic()
+
+
+@contextmanager
+def time_stage(stage: str):
+    """Context manager that records how long the block took against the given stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_duration.observe(stage, time.perf_counter() - start)
+
+
+def timed(stage: str):
+    """Decorator version of time_stage, for timing a whole function"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with time_stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def observe_rows(stage: str, rows: int) -> None:
+    stage_rows.observe(stage, rows)
+
+
+def observe_bytes(stage: str, size: int) -> None:
+    stage_bytes.observe(stage, size)
+
+
+def file_sizes(paths: list) -> int:
+    """Total size of the given files, ignoring any that have gone missing"""
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+@contextmanager
+def snapshot_lock(path: str):
+    """Stop two runs of the same process (e.g. overlapping poller runs) merging into a snapshot at the same time"""
+    if fcntl is None:
+        yield
+        return
+
+    with open(f"{path}.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def save_snapshot(name: str) -> None:
+    """Add what this process has recorded since its last save to its snapshot file, so the web app can expose it
+       (used by the poller and the scheduler). Counts add up across runs, like a Prometheus counter should.
+    """
+    os.makedirs(SNAPSHOT_FOLDER, exist_ok=True)
+    path = os.path.join(SNAPSHOT_FOLDER, f"{name}.json")
+
+    with snapshot_lock(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except (OSError, ValueError):
+            snapshot = {}
+
+        for histogram in HISTOGRAMS:
+            merge_stages(snapshot.setdefault(histogram.name, {}), histogram.drain())
+
+        # Write to a temp file then rename, so /metrics never reads a half written file
+        fd, temp_path = tempfile.mkstemp(dir=SNAPSHOT_FOLDER, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        os.replace(temp_path, path)
+
+
+def save_snapshot_periodically(name: str, interval: float = SNAPSHOT_INTERVAL) -> None:
+    """save_snapshot, at most once every interval seconds (called after every web request)"""
+    global last_saved
+
+    now = time.monotonic()
+    if now - last_saved < interval:
+        return
+    last_saved = now
+    save_snapshot(name)
+
+
+def load_snapshots() -> dict:
+    """Merge the snapshots left by every process into {histogram name: {stage: data}}"""
+    merged = {}
+    if not os.path.isdir(SNAPSHOT_FOLDER):
+        return merged
+
+    for filename in os.listdir(SNAPSHOT_FOLDER):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(SNAPSHOT_FOLDER, filename), 'r', encoding='utf-8') as snapshot_file:
+                for name, stages in json.load(snapshot_file).items():
+                    merge_stages(merged.setdefault(name, {}), stages)
+        except (OSError, ValueError):
+            continue
+
+    return merged
+
+
+def render() -> str:
+    """Render every histogram in the Prometheus text exposition format.
+       Only the snapshot files are read, never this process's memory: under gunicorn each scrape is answered by whichever
+       worker gets it, and the files are the one place every worker's counts add up (see app.metrics_endpoint).
+    """
+    snapshots = load_snapshots()
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines += histogram.render(snapshots.get(histogram.name, {}))
+    return "\n".join(lines) + "\n"
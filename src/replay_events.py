@@ -0,0 +1,95 @@
+# Standard library imports
+import os
+import hmac
+import json
+import time
+import hashlib
+import argparse
+import datetime
+
+# Third-party imports
+import requests
+
+# Local application imports
+import common
+
+# Constants
+DEFAULT_URL = "http://localhost:5000/api/events"
+WEBHOOK_SECRET = os.environ.get('ROBOT_TRACKER_WEBHOOK_SECRET')
+
+# Set up a global custom logger object for this script
+logger = common.setup_custom_logger("replay_events")
+
+
+def load_events(path: str) -> list:
+    """Read events from a JSONL file (one event per line), sorted by timestamp"""
+    with open(path, 'r', encoding='utf-8') as events_file:
+        events = [json.loads(line) for line in events_file if line.strip()]
+    return sorted(events, key=lambda event: event.get('timestamp', ''))
+
+
+def post_batch(session, url: str, batch: list) -> dict:
+    """Sign and send a batch of events to the ingestion endpoint"""
+    body = json.dumps(batch).encode('utf-8')
+    signature = hmac.new(WEBHOOK_SECRET.encode('utf-8'), body, hashlib.sha256).hexdigest()
+    response = session.post(url, data=body, headers={"Content-Type": "application/json", "X-Signature": signature}, timeout=(3.05, 27))
+    response.raise_for_status()
+    return response.json()
+
+
+def add_summary(totals: dict, summary: dict) -> None:
+    """Add an endpoint response to the running totals"""
+    totals["received"] += summary["received"]
+    totals["recorded"] += summary["recorded"]
+    totals["rejected"] += len(summary["rejected"])
+
+
+def replay(path: str, url: str, batch_size: int, speed: float) -> None:
+    """Replay the events to the ingestion endpoint.
+       With speed > 0 the gaps between event timestamps are reproduced (divided by speed), otherwise events are sent as fast as possible.
+    """
+
+    events = load_events(path)
+    logger.info(f"Replaying {len(events)} events from {path} to {url}")
+
+    totals = {"received": 0, "recorded": 0, "rejected": 0}
+    previous_time = None
+    batch = []
+    start = time.perf_counter()
+
+    with requests.Session() as session:
+        for event in events:
+            if speed > 0 and event.get('timestamp'):
+                event_time = datetime.datetime.fromisoformat(event['timestamp'])
+                if previous_time and event_time > previous_time:
+                    # Flush what we have so events arrive at roughly the right time
+                    if batch:
+                        add_summary(totals, post_batch(session, url, batch))
+                        batch = []
+                    time.sleep((event_time - previous_time).total_seconds() / speed)
+                previous_time = event_time
+
+            batch.append(event)
+            if len(batch) >= batch_size:
+                add_summary(totals, post_batch(session, url, batch))
+                batch = []
+
+        if batch:
+            add_summary(totals, post_batch(session, url, batch))
+
+    elapsed = time.perf_counter() - start
+    logger.info(f"Replay finished in {elapsed:.2f}s: {totals}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay availability events from a JSONL file to the ingestion endpoint")
+    parser.add_argument("events", help="JSONL file, one event per line")
+    parser.add_argument("--url", default=DEFAULT_URL)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--speed", type=float, default=0, help="Reproduce the gaps between events, sped up by this factor (0 = as fast as possible)")
+    args = parser.parse_args()
+
+    if not WEBHOOK_SECRET:
+        raise ValueError("ROBOT_TRACKER_WEBHOOK_SECRET not found in environment variables")
+
+    replay(args.events, args.url, args.batch_size, args.speed)
@@ -0,0 +1,142 @@
+# Standard library imports
+import os
+import sqlite3
+import argparse
+import threading
+from datetime import datetime
+from typing import List, Optional
+
+# Third-party imports
+import pandas as pd
+
+# Optional: only needed when report_engine is "duckdb"
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# Local application imports
+import common
+import metrics
+
+# Constants
+REPORT_STORE_FILE = 'RobotTracker.duckdb'
+SYNC_CHUNK_ROWS = 100000  # AgentEvent rows copied per chunk
+SYNC_INTERVAL = 30  # Minutes between syncs (see app.create_scheduler)
+
+# Columnar copy of the tables the reports read. AgentEvent keeps the SQLite rowid (so the report queries can order by
+# e.rowid on either engine) and is loaded in TS order, so DuckDB can skip whole row groups outside a date range.
+REPORT_STORE_SCHEMA = """
+CREATE TABLE Agent (ID BIGINT PRIMARY KEY, NAME VARCHAR NOT NULL, EMAIL VARCHAR, MANAGER VARCHAR);
+CREATE TABLE AgentEvent ("rowid" BIGINT, AGENT_ID BIGINT, TS BIGINT, SHIFT_DAY BIGINT, PREVIOUS_VALUE TINYINT, NEW_VALUE TINYINT);
+CREATE TABLE SyncInfo (SYNCED_TS BIGINT, EVENT_ROWS BIGINT);
+"""
+
+# Set up a global custom logger object for this script
+logger = common.setup_custom_logger("report_store")
+
+# Read-only connection to the current copy, reopened when a sync replaces the file
+store_lock = threading.Lock()
+store = {"connection": None, "mtime": None, "synced_ts": None}
+
+
+@metrics.timed("report_store.sync")
+def sync(database_name: Optional[str] = None, store_file: Optional[str] = None) -> int:
+    """Rebuild the DuckDB copy of Agent/AgentEvent from SQLite and return the number of events copied.
+       The copy is built in a temp file and renamed into place, so readers in other processes never see a partial copy
+       (DuckDB only lets one process at a time open a file for writing).
+    """
+
+    if duckdb is None:
+        logger.error("duckdb is not installed, can't sync the report store")
+        return 0
+
+    store_file = store_file or REPORT_STORE_FILE
+
+    # Anything recorded before this point is in the copy (events pushed late with an older timestamp wait for the next sync)
+    synced_ts = common.to_epoch(datetime.now())
+
+    temp_file = f"{store_file}.tmp"
+    if os.path.exists(temp_file):
+        os.remove(temp_file)
+
+    source = sqlite3.connect(database_name or common.DATABASE_NAME)
+    target = duckdb.connect(temp_file)
+    try:
+        target.execute(REPORT_STORE_SCHEMA)
+
+        agents = pd.read_sql_query("SELECT ID, NAME, EMAIL, MANAGER FROM Agent", source)
+        target.execute("INSERT INTO Agent SELECT * FROM agents")
+
+        rows = 0
+        for events in pd.read_sql_query(
+            "SELECT rowid, AGENT_ID, TS, SHIFT_DAY, PREVIOUS_VALUE, NEW_VALUE FROM AgentEvent WHERE TS < ? ORDER BY TS, rowid",
+            source, params=[synced_ts], chunksize=SYNC_CHUNK_ROWS
+        ):
+            target.execute("INSERT INTO AgentEvent SELECT * FROM events")
+            rows += len(events)
+
+        target.execute("INSERT INTO SyncInfo VALUES (?, ?)", [synced_ts, rows])
+        target.execute("CHECKPOINT")
+    finally:
+        target.close()
+        source.close()
+
+    os.replace(temp_file, store_file)
+    metrics.observe_rows("report_store.sync", rows)
+    logger.info(f"Report store synced: {rows} events up to {common.from_epoch(synced_ts)}")
+
+    return rows
+
+
+def connect(store_file: Optional[str] = None):
+    """Return a cursor on the current copy and the time it covers up to, or (None, None) if there isn't one"""
+
+    store_file = store_file or REPORT_STORE_FILE
+
+    if duckdb is None or not os.path.exists(store_file):
+        return None, None
+
+    with store_lock:
+        mtime = os.path.getmtime(store_file)
+        if store["connection"] is None or store["mtime"] != mtime:
+            if store["connection"] is not None:
+                store["connection"].close()
+            store["connection"] = duckdb.connect(store_file, read_only=True)
+            store["mtime"] = mtime
+            store["synced_ts"] = store["connection"].execute("SELECT SYNCED_TS FROM SyncInfo").fetchone()[0]
+            logger.info(f"Opened report store synced up to {common.from_epoch(store['synced_ts'])}")
+
+        # Each thread needs its own cursor
+        return store["connection"].cursor(), store["synced_ts"]
+
+
+def query(sql_query: str, query_parameters: List, until_ts: int) -> Optional[List]:
+    """Run a report query on the DuckDB copy if it covers everything up to until_ts (epoch seconds).
+       Returns None if it can't (no duckdb, no copy yet, the range is newer than the copy or the query fails),
+       in which case the caller should run it on SQLite.
+    """
+
+    try:
+        cursor, synced_ts = connect()
+        if cursor is None or until_ts >= synced_ts:
+            return None
+
+        with metrics.time_stage("report_store.query"):
+            results = cursor.execute(sql_query, query_parameters).fetchall()
+        cursor.close()
+
+        logger.info(f"Results fetched from report store: {len(results)}")
+        return results
+    except duckdb.Error as e:
+        logger.error(f"Report store query failed, falling back to SQLite: {e}")
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild the DuckDB report store from the SQLite database")
+    parser.add_argument("--database", help="SQLite database to copy (defaults to the app's database)")
+    parser.add_argument("--output", help=f"DuckDB file to write (defaults to {REPORT_STORE_FILE})")
+    args = parser.parse_args()
+
+    sync(args.database, args.output)
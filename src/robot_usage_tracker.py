@@ -5,19 +5,24 @@ import logging
 import base64
 import sqlite3
 import datetime
+from typing import Optional
 
 # Third-party imports
 import requests
 
 # Local application imports
 import common
+import schema
+import metrics
 
 # Constants
 API_KEY = os.environ.get('FRESHDESK_API_KEY')
-FRESHDESK_URL = f"https://freshdesk.com/api/v2/agents"
-SQL_QUERY_INSERT = "INSERT INTO AgentUsage (NAME, EMAIL, ACTUAL_DATE_TIME, SHIFT_DATE, PREVIOUS_VALUE, NEW_VALUE) VALUES (?, ?, ?, ?, ?, ?)"
-SQL_QUERY_SELECT_1 = "SELECT NAME FROM AgentUsage WHERE NAME = (?) AND SHIFT_DATE = (?)"
-SQL_QUERY_SELECT_2 = "SELECT NEW_VALUE FROM AgentUsage WHERE NAME = (?) ORDER BY rowid DESC LIMIT 1"
+FRESHDESK_URL = os.environ.get('FRESHDESK_URL', "https://freshdesk.com/api/v2/agents")
+SQL_QUERY_INSERT = "INSERT INTO AgentEvent (AGENT_ID, TS, SHIFT_DAY, PREVIOUS_VALUE, NEW_VALUE) VALUES (?, ?, ?, ?, ?)"
+SQL_QUERY_SELECT_1 = "SELECT 1 FROM AgentEvent WHERE AGENT_ID = (?) AND SHIFT_DAY = (?) LIMIT 1"
+SQL_QUERY_SELECT_2 = "SELECT NEW_VALUE, TS FROM AgentEvent WHERE AGENT_ID = (?) ORDER BY TS DESC, rowid DESC LIMIT 1"
+SQL_QUERY_UPSERT_AGENT = "INSERT INTO Agent (NAME, EMAIL) VALUES (?, ?) ON CONFLICT (NAME) DO UPDATE SET EMAIL = COALESCE(excluded.EMAIL, Agent.EMAIL)"
+SQL_QUERY_SELECT_AGENT_ID = "SELECT ID FROM Agent WHERE NAME = (?)"
 
 # Set up a global custom logger object for the script
 logger = common.setup_custom_logger("robot_usage_tracker")
@@ -67,8 +72,26 @@ def build_headers():
     return headers_to_include
 
 
-def send_requests(cursor, conn, headers_to_include, date_time):
-    """Send requests to the Freshdesk API and update the database"""
+def get_agent_id(cursor, agent: dict, agent_ids: dict) -> int:
+    """Return the agent's ID in the Agent table, adding them (or updating their email) the first time we see them in a run"""
+    
+    name = agent['contact']['name']
+    if name not in agent_ids:
+        cursor.execute(SQL_QUERY_UPSERT_AGENT, (name, agent['contact']['email']))
+        agent_ids[name] = cursor.execute(SQL_QUERY_SELECT_AGENT_ID, (name,)).fetchone()[0]
+    
+    return agent_ids[name]
+
+def is_rostered(name: str) -> bool:
+    """Check whether the agent is in the teams_hierarchy"""
+    return any(name in team for team in teams_hierarchy.values())
+
+def record_agent_state(cursor, agent: dict, date_time: datetime.datetime, agent_ids: dict) -> Optional[dict]:
+    """Record the agent's availability at date_time if it's their first entry of the shift or a state change.
+       agent is in the Freshdesk format: {'available': bool, 'contact': {'name': ..., 'email': ...}}
+       Returns the recorded change (for publishing once committed), or None if nothing was written.
+       The caller is responsible for committing.
+    """
     
     # If the hour is less than or equal to e.g. 5am, credit this entry to the previous shift/date.
     if date_time.hour <= shifts_times['shift_start']:
@@ -77,6 +100,62 @@ def send_requests(cursor, conn, headers_to_include, date_time):
         # Else credit to the current shift/date.
         date = date_time.date()
     
+    # The database stores both as integers (see common.to_epoch/common.to_shift_day)
+    ts = common.to_epoch(date_time)
+    shift_day = common.to_shift_day(date)
+    
+    agent_id = get_agent_id(cursor, agent, agent_ids)
+    
+    # What we publish to the live dashboard if a row gets written
+    change = {
+        "name": agent['contact']['name'],
+        "available": int(agent['available']),
+        "timestamp": date_time.strftime(r"%Y-%m-%d %H:%M:%S"),
+        "shift_date": date.isoformat(),
+    }
+    
+    # If the agent isn't in the database for the current shift date, record their initial state.
+    if not (cursor.execute(SQL_QUERY_SELECT_1, (agent_id, shift_day))).fetchone():
+        logger.info(f"No agent record for shift: {date}. Adding {agent['contact']['name']} to the database. Initial value = {agent['available']}")
+        cursor.execute(
+            SQL_QUERY_INSERT,
+            (agent_id, ts, shift_day, agent['available'], agent['available'])
+        )
+        return change
+    
+    # Else if they are in the database for the current shift, return their latest entry. 
+    returned_tuple = (cursor.execute(SQL_QUERY_SELECT_2, (agent_id,))).fetchone()
+    
+    # Convert the value at index 0 of the tuple into an integer. 
+    previous_available = int(returned_tuple[0])
+    
+    # Ignore events older than the latest one we hold (e.g. a webhook delivered late), they'd corrupt the sequence
+    if ts < returned_tuple[1]:
+        logger.info(f"Ignoring stale event for {agent['contact']['name']} at {date_time}")
+        return None
+    
+    # If there has been a state change
+    if agent['available'] != previous_available:
+        logger.info(f"State change detected for {agent['contact']['name']}. Logged in? Previous value: {True if previous_available else False}, New value: {agent['available']}")
+        logger.info(f"Updating database.....")
+        cursor.execute(
+            SQL_QUERY_INSERT,
+            (agent_id, ts, shift_day, previous_available, agent['available'])
+        )
+        return change
+    
+    return None
+
+@metrics.timed("poller.total")
+def send_requests(cursor, conn, headers_to_include, date_time):
+    """Send requests to the Freshdesk API and update the database"""
+    
+    # Cache of agent name --> Agent.ID for this run
+    agent_ids = {}
+    
+    # Changes recorded this run, published once they're committed
+    changes = []
+    
     # Agents are spread out over multiple pages, so we need to go through each page starting at page 1
     page = 1
 
@@ -87,7 +166,9 @@ def send_requests(cursor, conn, headers_to_include, date_time):
         
         # Send get request to url_with_page and save response object as response
         # Note timeout is set to a tuple which specifies the [0] connect and [1] read timeouts
-        response = requests.get(url_with_page, headers=headers_to_include, timeout=(3.05, 27))
+        with metrics.time_stage("poller.fetch_page"):
+            response = requests.get(url_with_page, headers=headers_to_include, timeout=(3.05, 27))
+        metrics.observe_bytes("poller.fetch_page", len(response.content))
         
         # If we get a successful response
         if response.status_code == 200:
@@ -96,32 +177,13 @@ def send_requests(cursor, conn, headers_to_include, date_time):
             agents = response.json()
 
             # Get a list of agents that are in the teams_hierarchy
-            filtered_agents = [agent for agent in agents if any(agent['contact']['name'] in name for name in teams_hierarchy.values())]
+            filtered_agents = [agent for agent in agents if is_rostered(agent['contact']['name'])]
+            metrics.observe_rows("poller.page_agents", len(filtered_agents))
 
             for agent in filtered_agents:
-                # If the agent isn't in the database for the current shift date, record their initial state.
-                
-                if not (cursor.execute(SQL_QUERY_SELECT_1, (agent['contact']['name'], date))).fetchone():
-                    logger.info(f"No agent record for shift: {date}. Adding {agent['contact']['name']} to the database. Initial value = {agent['available']}")
-                    cursor.execute(
-                        SQL_QUERY_INSERT,
-                        (agent['contact']['name'], agent['contact']['email'], date_time.strftime(r"%Y-%m-%d %H:%M:%S"), date, agent['available'], agent['available'])
-                    )
-                else: 
-                    # Else if they are in the database for the current shift, return their latest entry. 
-                    returned_tuple = (cursor.execute(SQL_QUERY_SELECT_2, (agent['contact']['name'],))).fetchone()
-                    
-                    # Convert the value at index 0 of the tuple into an integer. 
-                    previous_available = int(returned_tuple[0])
-                    
-                    # If there has been a state change
-                    if agent['available'] != previous_available:
-                        logger.info(f"State change detected for {agent['contact']['name']}. Logged in? Previous value: {True if previous_available else False}, New value: {agent['available']}")
-                        logger.info(f"Updating database.....")
-                        cursor.execute(
-                            SQL_QUERY_INSERT,
-                            (agent['contact']['name'], agent['contact']['email'], date_time.strftime(r"%Y-%m-%d %H:%M:%S"), date, previous_available, agent['available'])
-                        )
+                change = record_agent_state(cursor, agent, date_time, agent_ids)
+                if change:
+                    changes.append(change)
                 
             # If below is true, we know we are on the last page.
             if len(agents) < 100:
@@ -138,6 +200,9 @@ def send_requests(cursor, conn, headers_to_include, date_time):
         conn.commit()
 
         logger.info("Database update complete. Closing database connection")
+        
+        # Let the live dashboard know
+        common.publish_changes(changes)
     except:
         # If there's an issue with our commit
         logger.error("Error committing changes to database. No changes have been made.")
@@ -145,6 +210,76 @@ def send_requests(cursor, conn, headers_to_include, date_time):
     conn.close()
     logger.info("Successfully closed Database connection")      
 
+def parse_event(event: dict):
+    """Validate a pushed availability event and convert it to (agent, date_time).
+       Expected format: {"name": ..., "email": ..., "available": true/false, "timestamp": "YYYY-MM-DD HH:MM:SS" (optional)}
+       Raises ValueError with the reason if the event is invalid.
+    """
+    
+    if not isinstance(event, dict):
+        raise ValueError("Event must be a JSON object")
+    
+    name = event.get('name')
+    if not name or not is_rostered(name):
+        raise ValueError(f"Agent {name!r} is not in the teams hierarchy")
+    
+    if not isinstance(event.get('available'), bool):
+        raise ValueError("'available' must be true or false")
+    
+    if event.get('timestamp'):
+        try:
+            date_time = datetime.datetime.fromisoformat(str(event['timestamp']))
+        except ValueError:
+            raise ValueError(f"Invalid timestamp {event['timestamp']!r}")
+        # The database holds local (naive) times, like the poller records
+        if date_time.tzinfo:
+            date_time = date_time.astimezone().replace(tzinfo=None)
+    else:
+        date_time = datetime.datetime.now()
+    
+    agent = {'available': event['available'], 'contact': {'name': name, 'email': event.get('email')}}
+    
+    return agent, date_time
+
+def ingest_events(events: list) -> dict:
+    """Record a batch of pushed availability events in a single transaction.
+       Returns a summary of how many were received/recorded and why any were rejected.
+    """
+    
+    accepted = []
+    rejected = []
+    for index, event in enumerate(events):
+        try:
+            accepted.append(parse_event(event))
+        except ValueError as e:
+            rejected.append({"index": index, "error": str(e)})
+    
+    # Apply the batch in time order so each agent's sequence of states is built up correctly
+    accepted.sort(key=lambda item: item[1])
+    
+    changes = []
+    agent_ids = {}
+    conn = sqlite3.connect(common.DATABASE_NAME, timeout=30)
+    try:
+        with conn:
+            cursor = conn.cursor()
+            for agent, date_time in accepted:
+                change = record_agent_state(cursor, agent, date_time, agent_ids)
+                if change:
+                    changes.append(change)
+    finally:
+        conn.close()
+    
+    # Only publish once the transaction has committed
+    common.publish_changes(changes)
+    
+    recorded = len(changes)
+    
+    metrics.observe_rows("ingest.recorded", recorded)
+    logger.info(f"Ingested {len(events)} event(s): {recorded} recorded, {len(rejected)} rejected")
+    
+    return {"received": len(events), "recorded": recorded, "rejected": rejected}
+
 def main():
     """Main function to run the script""" 
     
@@ -154,6 +289,9 @@ def main():
     # Record the current datetime
     date_time = datetime.datetime.now()
     
+    # Make sure the Agent/AgentEvent tables exist (legacy data is migrated by running schema.py)
+    schema.ensure_schema()
+    
     # Connect to our sqlite database
     try:
         conn = sqlite3.connect(r"RobotTracker.db")
@@ -165,6 +303,9 @@ def main():
     
     # Send requests to the Freshdesk API and update the database
     send_requests(cursor, conn, headers_to_include, date_time)
+    
+    # Leave this run's timings where the web app's /metrics endpoint can pick them up
+    metrics.save_snapshot("poller")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,28 @@
+# Third-party imports
+from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR
+from apscheduler.schedulers.blocking import BlockingScheduler
+
+# Local application imports
+import common
+import metrics
+from app import create_scheduler
+
+# Set up a global custom logger object for this script
+logger = common.setup_custom_logger("scheduler")
+
+
+def save_metrics(event) -> None:
+    """Hand the finished job's histograms over to the web app's /metrics (this process has no endpoint of its own)"""
+    try:
+        metrics.save_snapshot("scheduler")
+    except Exception:
+        logger.exception(f"Could not save the metrics snapshot after job {event.job_id}")
+
+
+if __name__ == '__main__':
+    # Runs the background jobs in their own process when the web app is served by a WSGI server (see wsgi.py)
+    scheduler = create_scheduler(BlockingScheduler)
+    scheduler.add_listener(save_metrics, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+    
+    logger.info("Starting scheduler")
+    scheduler.start()
@@ -0,0 +1,258 @@
+# Standard library imports
+import sqlite3
+import argparse
+
+# Local application imports
+import common
+
+# Set up a global custom logger object for this script
+logger = common.setup_custom_logger("schema")
+
+# Subscriptions are split into subscribers, their subscriptions and the agents each subscription covers.
+# The agents are keyed on a hash of the sorted agent set, so re-ordering the agents can't create a duplicate
+# and subscribers watching the same agents share one set of rows.
+SUBSCRIPTION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS Subscriber (
+    ID INTEGER PRIMARY KEY,
+    TO_EMAIL TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS Subscription (
+    ID INTEGER PRIMARY KEY,
+    SUBSCRIBER_ID INTEGER NOT NULL REFERENCES Subscriber (ID),
+    AGENT_SET_HASH TEXT NOT NULL,
+    DAILY INTEGER NOT NULL DEFAULT 0,
+    WEEKLY INTEGER NOT NULL DEFAULT 0,
+    ATTACHMENT_FORMAT TEXT NOT NULL DEFAULT 'csv'
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_subscription_unique
+    ON Subscription (SUBSCRIBER_ID, AGENT_SET_HASH, DAILY, WEEKLY);
+
+CREATE INDEX IF NOT EXISTS idx_subscription_agent_set
+    ON Subscription (AGENT_SET_HASH);
+
+CREATE TABLE IF NOT EXISTS SubscriptionAgent (
+    AGENT_SET_HASH TEXT NOT NULL,
+    AGENT_NAME TEXT NOT NULL,
+    PRIMARY KEY (AGENT_SET_HASH, AGENT_NAME)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_subscription_agent_name
+    ON SubscriptionAgent (AGENT_NAME);
+"""
+
+# Usage events are stored compactly: one row per agent in the Agent dimension, and events that reference it by
+# integer ID with integer timestamps. TS is seconds since 1970-01-01 of the (naive) ACTUAL_DATE_TIME and SHIFT_DAY
+# is days since 1970-01-01 of the SHIFT_DATE, see common.to_epoch/common.to_shift_day.
+AGENT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS Agent (
+    ID INTEGER PRIMARY KEY,
+    NAME TEXT NOT NULL UNIQUE,
+    EMAIL TEXT,
+    MANAGER TEXT
+);
+
+CREATE TABLE IF NOT EXISTS AgentEvent (
+    AGENT_ID INTEGER NOT NULL REFERENCES Agent (ID),
+    TS INTEGER NOT NULL,
+    SHIFT_DAY INTEGER NOT NULL,
+    PREVIOUS_VALUE INTEGER NOT NULL,
+    NEW_VALUE INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_agentevent_ts
+    ON AgentEvent (TS);
+
+CREATE INDEX IF NOT EXISTS idx_agentevent_agent_ts
+    ON AgentEvent (AGENT_ID, TS);
+
+CREATE INDEX IF NOT EXISTS idx_agentevent_agent_shift_day
+    ON AgentEvent (AGENT_ID, SHIFT_DAY);
+"""
+
+# Compatibility view with the same columns as the old AgentUsage table, so existing queries (and inserts) keep working.
+# Note the new code queries Agent/AgentEvent directly, as filtering on the view's text columns can't use the indexes.
+AGENT_USAGE_VIEW = """
+CREATE VIEW IF NOT EXISTS AgentUsage AS
+SELECT a.NAME AS NAME,
+       a.EMAIL AS EMAIL,
+       datetime(e.TS, 'unixepoch') AS ACTUAL_DATE_TIME,
+       date(e.SHIFT_DAY * 86400, 'unixepoch') AS SHIFT_DATE,
+       e.PREVIOUS_VALUE AS PREVIOUS_VALUE,
+       e.NEW_VALUE AS NEW_VALUE
+FROM AgentEvent e
+JOIN Agent a ON a.ID = e.AGENT_ID;
+
+CREATE TRIGGER IF NOT EXISTS AgentUsage_insert INSTEAD OF INSERT ON AgentUsage
+BEGIN
+    INSERT OR IGNORE INTO Agent (NAME, EMAIL) VALUES (NEW.NAME, NEW.EMAIL);
+    INSERT INTO AgentEvent (AGENT_ID, TS, SHIFT_DAY, PREVIOUS_VALUE, NEW_VALUE)
+    VALUES (
+        (SELECT ID FROM Agent WHERE NAME = NEW.NAME),
+        CAST(strftime('%s', NEW.ACTUAL_DATE_TIME) AS INTEGER),
+        CAST(julianday(NEW.SHIFT_DATE) - 2440587.5 AS INTEGER),
+        CAST(NEW.PREVIOUS_VALUE AS INTEGER),
+        CAST(NEW.NEW_VALUE AS INTEGER)
+    );
+END;
+"""
+
+
+def table_exists(conn, name: str) -> bool:
+    """Check sqlite_master for a table with the given name"""
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+def migrate_agent_usage_table(conn) -> None:
+    """Move the rows of the legacy AgentUsage table into Agent/AgentEvent, then drop the legacy table (one-off)"""
+
+    if not table_exists(conn, "AgentUsage"):
+        return
+
+    logger.info("Migrating legacy AgentUsage table into Agent/AgentEvent...")
+
+    conn.execute("INSERT OR IGNORE INTO Agent (NAME, EMAIL) SELECT NAME, MAX(EMAIL) FROM AgentUsage GROUP BY NAME")
+
+    # Rows recorded before SHIFT_DATE existed are credited to the previous day if they're before the shift start
+    # (the same rule create_csv used), which is just the timestamp shifted back by shift_start hours.
+    cursor = conn.execute(
+        """INSERT INTO AgentEvent (AGENT_ID, TS, SHIFT_DAY, PREVIOUS_VALUE, NEW_VALUE)
+        SELECT a.ID,
+               CAST(strftime('%s', u.ACTUAL_DATE_TIME) AS INTEGER),
+               COALESCE(
+                   CAST(julianday(u.SHIFT_DATE) - 2440587.5 AS INTEGER),
+                   (CAST(strftime('%s', u.ACTUAL_DATE_TIME) AS INTEGER) - ? * 3600) / 86400
+               ),
+               CAST(u.PREVIOUS_VALUE AS INTEGER),
+               CAST(u.NEW_VALUE AS INTEGER)
+        FROM AgentUsage u
+        JOIN Agent a ON a.NAME = u.NAME
+        ORDER BY u.rowid""",
+        (common.shifts_times['shift_start'],)
+    )
+
+    # Compare with the rows this INSERT copied, not the size of AgentEvent, which may already hold rows the poller wrote
+    legacy_rows = conn.execute("SELECT COUNT(*) FROM AgentUsage").fetchone()[0]
+    migrated_rows = cursor.rowcount
+    if legacy_rows != migrated_rows:
+        # Raising rolls back the whole transaction, leaving the legacy table as it was
+        raise sqlite3.DatabaseError(f"AgentUsage migration copied {migrated_rows} of {legacy_rows} rows")
+
+    conn.execute("DROP TABLE AgentUsage")
+
+    logger.info(f"Migrated {migrated_rows} AgentUsage rows. Run 'python schema.py --vacuum' to shrink the database file.")
+
+
+def sync_agent_managers(conn, teams_hierarchy: dict = None) -> None:
+    """Record each agent's manager from the teams hierarchy in the Agent table"""
+
+    teams_hierarchy = teams_hierarchy or common.teams_hierarchy
+
+    conn.executemany(
+        "INSERT INTO Agent (NAME, MANAGER) VALUES (?, ?) ON CONFLICT (NAME) DO UPDATE SET MANAGER = excluded.MANAGER",
+        [(agent, manager) for manager, agents in teams_hierarchy.items() for agent in agents]
+    )
+
+
+def migrate_email_table(conn) -> None:
+    """Copy the legacy comma-joined Email table into the normalized subscription tables (one-off)"""
+
+    if not table_exists(conn, "Email"):
+        return
+
+    logger.info("Migrating legacy Email table into Subscriber/Subscription/SubscriptionAgent...")
+
+    rows = conn.execute("SELECT TO_EMAIL, AGENTS, DAILY, WEEKLY FROM Email").fetchall()
+
+    for to_email, agents_string, daily, weekly in rows:
+        agents = [agent for agent in agents_string.split(',') if agent]
+        agent_set_hash = common.agent_set_hash(agents)
+
+        conn.execute("INSERT INTO Subscriber (TO_EMAIL) VALUES (?) ON CONFLICT (TO_EMAIL) DO NOTHING", (to_email,))
+        conn.executemany(
+            "INSERT OR IGNORE INTO SubscriptionAgent (AGENT_SET_HASH, AGENT_NAME) VALUES (?, ?)",
+            [(agent_set_hash, agent) for agent in set(agents)]
+        )
+        conn.execute(
+            "INSERT OR IGNORE INTO Subscription (SUBSCRIBER_ID, AGENT_SET_HASH, DAILY, WEEKLY) "
+            "SELECT ID, ?, ?, ? FROM Subscriber WHERE TO_EMAIL = ?",
+            (agent_set_hash, int(daily), int(weekly), to_email)
+        )
+
+    # Keep the old rows around for reference, but out of the way so the migration only runs once
+    conn.execute("ALTER TABLE Email RENAME TO Email_legacy")
+
+    logger.info(f"Migrated {len(rows)} legacy email subscription(s).")
+
+
+def add_attachment_format_column(conn) -> None:
+    """Add the ATTACHMENT_FORMAT column (csv, parquet or arrow) to a Subscription table created before it existed"""
+
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(Subscription)")]
+    if "ATTACHMENT_FORMAT" not in columns:
+        conn.execute("ALTER TABLE Subscription ADD COLUMN ATTACHMENT_FORMAT TEXT NOT NULL DEFAULT 'csv'")
+        logger.info("Added ATTACHMENT_FORMAT to Subscription.")
+
+
+def vacuum(database_name: str = None, incremental: bool = False) -> None:
+    """Rebuild the database file to return free space, optionally switching to incremental auto-vacuum
+       so the retention job can hand freed pages back to the filesystem from then on.
+       A full VACUUM rewrites the whole file, so this is a one-off that should be run while the app is stopped.
+    """
+
+    conn = sqlite3.connect(database_name or common.DATABASE_NAME)
+
+    if incremental:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+    logger.info("Running a full VACUUM...")
+    conn.execute("VACUUM")
+    logger.info(f"VACUUM complete (auto_vacuum mode: {conn.execute('PRAGMA auto_vacuum').fetchone()[0]}).")
+
+    conn.close()
+
+
+def ensure_schema(database_name: str = None, migrate_legacy_usage: bool = False) -> None:
+    """Create any missing tables/indexes and run outstanding migrations. Safe to call on every start up.
+       The AgentUsage migration copies every row of history, so it only runs when asked for (python schema.py):
+       under gunicorn, a long migration at import would be killed by the worker boot timeout and rolled back over and over.
+    """
+
+    try:
+        conn = sqlite3.connect(database_name or common.DATABASE_NAME)
+
+        # Create any missing tables/indexes (all IF NOT EXISTS)
+        conn.executescript(SUBSCRIPTION_SCHEMA + AGENT_SCHEMA)
+
+        # Run the migrations in a single transaction so a failed migration leaves the database untouched
+        with conn:
+            if migrate_legacy_usage:
+                migrate_agent_usage_table(conn)
+            sync_agent_managers(conn)
+            migrate_email_table(conn)
+            add_attachment_format_column(conn)
+
+        # The view can only be created once the legacy AgentUsage table is gone
+        if table_exists(conn, "AgentUsage"):
+            conn.close()
+            logger.error("The legacy AgentUsage table hasn't been migrated yet. Stop the app and run 'python schema.py' to migrate it.")
+            return
+        conn.executescript(AGENT_USAGE_VIEW)
+
+        conn.close()
+        logger.info("Database schema is up to date.")
+    except sqlite3.Error as e:
+        logger.error(f"Error updating database schema: {e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create/migrate the Robot Usage Tracker database schema (run before starting the app after an upgrade)")
+    parser.add_argument("--vacuum", action="store_true", help="Also run a full VACUUM to shrink the file (e.g. after a migration)")
+    parser.add_argument("--incremental-vacuum", action="store_true", help="Also switch the database to incremental auto-vacuum (one-off full VACUUM)")
+    args = parser.parse_args()
+
+    ensure_schema(migrate_legacy_usage=True)
+
+    if args.vacuum or args.incremental_vacuum:
+        vacuum(incremental=args.incremental_vacuum)
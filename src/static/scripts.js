@@ -63,9 +63,10 @@ function emailVerification(validDomains) {
     }
 }
 
-async function downloadCSV() {
-    window.location.href = '/download_csv';
-    alert("CSV download started - please check your downloads folder!");
+async function downloadCSV(format) {
+    // format is optional: 'parquet' or 'arrow' (defaults to CSV)
+    window.location.href = '/download_csv' + (format ? '?format=' + format : '');
+    alert((format ? format.charAt(0).toUpperCase() + format.slice(1) : "CSV") + " download started - please check your downloads folder!");
 }
 
 function setDateRange(startDate, endDate) {
@@ -134,3 +135,52 @@ function setLastThreeMonths() {
 
     setDateRange(firstDayOfLastThreeMonths, lastDayOfLastThreeMonths);
 }
+
+function updateTeamCounts() {
+    const counts = {};
+    document.querySelectorAll('.agent-state').forEach(function(badge) {
+        counts[badge.dataset.manager] = (counts[badge.dataset.manager] || 0) + Number(badge.dataset.available);
+    });
+    document.querySelectorAll('.team-count').forEach(function(count) {
+        count.textContent = counts[count.dataset.manager] || 0;
+    });
+}
+
+function startLiveDashboard() {
+    const status = document.getElementById('live-status');
+    const feed = document.getElementById('live-feed');
+    updateTeamCounts();
+
+    // The browser reconnects automatically if the stream drops
+    const source = new EventSource('/live/stream');
+    source.onopen = function() {
+        status.textContent = 'Live';
+        status.className = 'badge text-bg-success';
+    };
+    source.onerror = function() {
+        status.textContent = 'Reconnecting...';
+        status.className = 'badge text-bg-warning';
+    };
+    source.onmessage = function(event) {
+        const change = JSON.parse(event.data);
+        const badge = document.querySelector('.agent-state[data-agent="' + CSS.escape(change.name) + '"]');
+        if (!badge) {
+            return; // Not on this dashboard
+        }
+
+        // Update the agent in place
+        badge.dataset.available = change.available;
+        badge.title = 'Last change: ' + change.timestamp;
+        badge.classList.toggle('text-bg-success', change.available === 1);
+        badge.classList.toggle('text-bg-secondary', change.available !== 1);
+        updateTeamCounts();
+
+        // Add to the top of the feed, keeping the last 50 changes
+        const item = document.createElement('li');
+        item.textContent = change.timestamp + ' - ' + change.name + (change.available ? ' is now available' : ' is no longer available');
+        feed.prepend(item);
+        while (feed.children.length > 50) {
+            feed.removeChild(feed.lastChild);
+        }
+    };
+}
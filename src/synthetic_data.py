@@ -0,0 +1,132 @@
+# Standard library imports
+import random
+import sqlite3
+import argparse
+import datetime
+
+# Local application imports
+import common
+import schema
+
+# Set up a global custom logger object for this script
+logger = common.setup_custom_logger("synthetic_data")
+
+# Same layout as the legacy AgentUsage and Email tables. schema.ensure_schema() then migrates them to the live schema
+# exactly as it would a production database.
+SYNTHETIC_SCHEMA = """
+CREATE TABLE IF NOT EXISTS AgentUsage (
+    NAME TEXT,
+    EMAIL TEXT,
+    ACTUAL_DATE_TIME TEXT,
+    SHIFT_DATE TEXT,
+    PREVIOUS_VALUE INTEGER,
+    NEW_VALUE INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS Email (
+    TO_EMAIL TEXT,
+    AGENTS TEXT,
+    DAILY INTEGER,
+    WEEKLY INTEGER
+);
+"""
+SQL_QUERY_INSERT = "INSERT INTO AgentUsage (NAME, EMAIL, ACTUAL_DATE_TIME, SHIFT_DATE, PREVIOUS_VALUE, NEW_VALUE) VALUES (?, ?, ?, ?, ?, ?)"
+SHIFT_HOURS = 23  # The poller runs from just after shift_start until shift_start the next day
+
+
+def build_roster(agents: int, managers: int) -> dict:
+    """Return a teams_hierarchy style dictionary with the agents spread evenly across the managers"""
+    roster = {f"Manager{m + 1}": [] for m in range(managers)}
+    for a in range(agents):
+        roster[f"Manager{a % managers + 1}"].append(f"Agent{a + 1:04d}")
+    return roster
+
+
+def generate_usage_rows(roster: dict, days: int, state_changes_per_day: float, end_date: datetime.date, rng: random.Random):
+    """Yield AgentUsage rows in the order the poller would have written them.
+       Each agent gets an initial-state row at the start of every shift followed by alternating state changes.
+    """
+
+    shift_start = common.shifts_times['shift_start']
+    agents = [agent for team in roster.values() for agent in team]
+
+    for day in range(days, 0, -1):
+        shift_date = end_date - datetime.timedelta(days=day)
+        shift_begins = datetime.datetime.combine(shift_date, datetime.time(shift_start + 1))
+
+        events = []
+        for agent in agents:
+            # First poll of the shift records the initial state with PREVIOUS_VALUE == NEW_VALUE
+            state = rng.randint(0, 1)
+            events.append((shift_begins, agent, state, state))
+
+            # State changes at random points through the shift (Poisson-ish around the configured rate)
+            changes = max(0, int(rng.gauss(state_changes_per_day, state_changes_per_day / 3)))
+            for offset in sorted(rng.uniform(0, SHIFT_HOURS * 3600) for _ in range(changes)):
+                events.append((shift_begins + datetime.timedelta(seconds=int(offset)), agent, state, 1 - state))
+                state = 1 - state
+
+        # Write in timestamp order, as the poller would have
+        events.sort(key=lambda event: event[0])
+        for timestamp, agent, previous_value, new_value in events:
+            yield (agent, f"{agent.lower()}@outlook.com", timestamp.strftime(r"%Y-%m-%d %H:%M:%S"), shift_date.isoformat(), previous_value, new_value)
+
+
+def generate_email_rows(roster: dict, subscribers: int, rng: random.Random):
+    """Yield legacy Email rows: mostly whole-team subscriptions plus some random agent picks"""
+
+    teams = list(roster.values())
+    agents = [agent for team in teams for agent in team]
+
+    for s in range(subscribers):
+        if rng.random() < 0.7:
+            picked = rng.choice(teams)
+        else:
+            picked = rng.sample(agents, k=min(len(agents), rng.randint(1, 10)))
+        daily = int(rng.random() < 0.5)
+        yield (f"subscriber{s}.test@outlook.com", ",".join(picked), daily, 1 - daily)
+
+
+def generate(database_name: str, agents: int = 20, managers: int = 2, days: int = 30, state_changes_per_day: float = 6,
+             subscribers: int = 50, end_date: datetime.date = None, seed: int = 1) -> dict:
+    """Build a synthetic RobotTracker database and return the roster used"""
+
+    rng = random.Random(seed)
+    end_date = end_date or datetime.date.today()
+    roster = build_roster(agents, managers)
+
+    logger.info(f"Generating synthetic data in {database_name}: {agents} agents, {days} days, ~{state_changes_per_day} state changes/agent/day, {subscribers} subscribers")
+
+    conn = sqlite3.connect(database_name)
+    conn.executescript(SYNTHETIC_SCHEMA)
+    with conn:
+        conn.executemany(SQL_QUERY_INSERT, generate_usage_rows(roster, days, state_changes_per_day, end_date, rng))
+        conn.executemany("INSERT INTO Email (TO_EMAIL, AGENTS, DAILY, WEEKLY) VALUES (?, ?, ?, ?)", generate_email_rows(roster, subscribers, rng))
+    rows = conn.execute("SELECT COUNT(*) FROM AgentUsage").fetchone()[0]
+    conn.close()
+
+    # Bring the synthetic database up to the current schema (Agent/AgentEvent, normalized subscriptions)
+    schema.ensure_schema(database_name, migrate_legacy_usage=True)
+
+    # Record the synthetic managers against the agents
+    conn = sqlite3.connect(database_name)
+    with conn:
+        schema.sync_agent_managers(conn, roster)
+    conn.close()
+
+    logger.info(f"Synthetic database ready: {rows} AgentUsage rows")
+    return roster
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a synthetic RobotTracker database")
+    parser.add_argument("database", help="Path of the SQLite file to create")
+    parser.add_argument("--agents", type=int, default=20)
+    parser.add_argument("--managers", type=int, default=2)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--state-changes", type=float, default=6, help="Average state changes per agent per shift")
+    parser.add_argument("--subscribers", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    generate(args.database, args.agents, args.managers, args.days, args.state_changes, args.subscribers, seed=args.seed)
@@ -1,9 +1,14 @@
 # Standard library imports
 import os
+import csv
+import gzip
+import shutil
 import sqlite3
 import datetime
+import time
 import smtplib
 from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
 from email import encoders
 from email.utils import formatdate
 from email.mime.text import MIMEText
@@ -13,68 +18,133 @@ from email.mime.image import MIMEImage
 
 # Local application imports
 import common
+import metrics
+
+# Constants
+SMTP_SERVER = os.environ.get('SMTP_SERVER', 'smtp-server')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 25))
+SMTP_USERNAME = os.environ.get('SMTP_USERNAME')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD')
+SMTP_CONNECTIONS = 2  # Number of SMTP sessions shared by the email batch
+SMTP_SEND_ATTEMPTS = 3  # Attempts per message before it is counted as failed
+SMTP_RETRY_DELAY = 2  # Seconds to wait between attempts (doubled each retry)
+RETENTION_BATCH_SIZE = 5000  # Rows archived/deleted per transaction by the cleanup job
+RETENTION_BATCH_PAUSE = 0.05  # Seconds to pause between batches so the poller and /filter can get a write lock
+ARCHIVE_FOLDER = os.path.join('archive', 'AgentUsage')
+PREWARM_FOLDER = 'prewarm'  # Under static/temp, one subfolder per pre-warm run
+PREWARM_RUNS_TO_KEEP = 2  # Older runs' files are deleted (their cache entries have expired by then)
+PRESET_START_TIME = datetime.time(3, 0)  # Same times setDateRange() in scripts.js puts on the form
+PRESET_END_TIME = datetime.time(2, 30)
+
+SQL_UPSERT_SUBSCRIBER = "INSERT INTO Subscriber (TO_EMAIL) VALUES (?) ON CONFLICT (TO_EMAIL) DO NOTHING"
+SQL_UPSERT_SUBSCRIPTION_AGENT = "INSERT INTO SubscriptionAgent (AGENT_SET_HASH, AGENT_NAME) VALUES (?, ?) ON CONFLICT DO NOTHING"
+SQL_UPSERT_SUBSCRIPTION = """INSERT INTO Subscription (SUBSCRIBER_ID, AGENT_SET_HASH, DAILY, WEEKLY, ATTACHMENT_FORMAT)
+    SELECT ID, ?, ?, ?, ? FROM Subscriber WHERE TO_EMAIL = ?
+    ON CONFLICT (SUBSCRIBER_ID, AGENT_SET_HASH, DAILY, WEEKLY) DO UPDATE SET ATTACHMENT_FORMAT = excluded.ATTACHMENT_FORMAT
+    WHERE ATTACHMENT_FORMAT != excluded.ATTACHMENT_FORMAT"""
+# One statement, so the subscribers and agents are read from the same snapshot even if a subscription is added mid-read
+SQL_SELECT_SUBSCRIPTIONS = """SELECT s.AGENT_SET_HASH, sub.TO_EMAIL, s.ATTACHMENT_FORMAT, sa.AGENT_NAME FROM Subscription s
+    JOIN Subscriber sub ON sub.ID = s.SUBSCRIBER_ID
+    JOIN SubscriptionAgent sa ON sa.AGENT_SET_HASH = s.AGENT_SET_HASH
+    WHERE s.{column} = ?"""
 
 # Global Logger setup
 logger = common.setup_custom_logger("utilities")
 
 # *** WEEKLY DATABASE CLEANUP ***
-def delete_old_records() -> None:
-    """ Function to delete old records from the database """
-    # Note we could call the generic connect_to_database function from common.py 
+def archive_rows(rows: list) -> None:
+    """ Append expiring AgentUsage rows to compressed archive files, one file per month of ACTUAL_DATE_TIME """
+    
+    headers = ["NAME", "EMAIL", "ACTUAL_DATE_TIME", "SHIFT_DATE", "PREVIOUS_VALUE", "NEW_VALUE"]
+    
+    # Group the rows by month so each archive file is only opened once per batch
+    partitions = {}
+    for row in rows:
+        partitions.setdefault(str(row[2])[:7], []).append(row)
+    
+    os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
+    
+    for month, partition_rows in partitions.items():
+        archive_path = os.path.join(ARCHIVE_FOLDER, f"AgentUsage_{month}.csv.gz")
+        new_file = not os.path.exists(archive_path)
+        
+        # Appending to a gzip file adds a new member, which gzip/pandas read back as one continuous file
+        with gzip.open(archive_path, 'at', newline='', encoding='utf-8') as archive_file:
+            writer = csv.writer(archive_file)
+            if new_file:
+                writer.writerow(headers)
+            writer.writerows(partition_rows)
+
+@metrics.timed("retention.total")
+def delete_old_records() -> dict:
+    """ Archive then delete records older than the retention limit in small batches, then return the free space to the filesystem.
+        Each batch is its own short transaction, so the poller and web requests aren't locked out for the whole run.
+    """
     
     logger.info("Executing weekly DB Cleanup job...")
+    
+    summary = {"rows_deleted": 0, "bytes_reclaimed": 0}
 
     try:
-        conn = sqlite3.connect("RobotTracker.db")
+        conn = sqlite3.connect(common.DATABASE_NAME, timeout=30)
         
-        cursor = conn.cursor()
-    
-        # Build query to delete entries older than specified number of years
-        query = f"DELETE FROM AgentUsage WHERE ACTUAL_DATE_TIME < DATE('now', '-{common.database_years} year')"
+        # Work out the cut-off (in AgentEvent.TS seconds) once so every batch uses the same boundary
+        cutoff = conn.execute("SELECT CAST(strftime('%s', DATE('now', ?)) AS INTEGER)", (f"-{common.database_years} year",)).fetchone()[0]
         
-        # Execute query
-        cursor.execute(query)
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        pages_before = conn.execute("PRAGMA page_count").fetchone()[0]
         
-        # Get the number of deleted rows
-        deleted_rows = cursor.rowcount
+        while True:
+            # Oldest rows first, using the TS index. Archived in the same text layout as the AgentUsage view.
+            rows = conn.execute(
+                "SELECT e.rowid, a.NAME, a.EMAIL, datetime(e.TS, 'unixepoch'), date(e.SHIFT_DAY * 86400, 'unixepoch'), e.PREVIOUS_VALUE, e.NEW_VALUE "
+                "FROM AgentEvent e JOIN Agent a ON a.ID = e.AGENT_ID "
+                "WHERE e.TS < ? ORDER BY e.TS LIMIT ?",
+                (cutoff, RETENTION_BATCH_SIZE)
+            ).fetchall()
+            
+            if not rows:
+                break
+            
+            # Export before deleting. If we fail in between, the next run archives the batch again rather than losing it.
+            with metrics.time_stage("retention.archive"):
+                archive_rows([row[1:] for row in rows])
+            
+            with metrics.time_stage("retention.delete"), conn:
+                conn.executemany("DELETE FROM AgentEvent WHERE rowid = ?", [(row[0],) for row in rows])
+            
+            summary["rows_deleted"] += len(rows)
+            logger.info(f"Archived and deleted {len(rows)} rows (running total: {summary['rows_deleted']}).")
+            
+            time.sleep(RETENTION_BATCH_PAUSE)
         
-        if deleted_rows > 0:
-            logger.info(f"Deleting {deleted_rows} rows due to max age limit reached ({common.database_years} years).")
+        if summary["rows_deleted"] > 0:
+            logger.info(f"Deleted {summary['rows_deleted']} rows due to max age limit reached ({common.database_years} years).")
         else:
             logger.info("No rows deleted. All Database records are within the allowed age limit.")
         
-        # Commit the changes
-        conn.commit() 
+        # Hand the free pages back to the filesystem (only possible in incremental auto-vacuum mode)
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            # The pragma frees one page per step. executescript() runs it to completion, where execute() would only free the first page.
+            conn.executescript("PRAGMA incremental_vacuum;")
+            pages_after = conn.execute("PRAGMA page_count").fetchone()[0]
+            summary["bytes_reclaimed"] = (pages_before - pages_after) * page_size
+            logger.info(f"Incremental vacuum reclaimed {summary['bytes_reclaimed']} bytes.")
+        else:
+            logger.warning("Incremental auto-vacuum is not enabled, free pages will be reused but not returned to the filesystem. Run 'python schema.py --incremental-vacuum' to enable it.")
         
         # Close the database connection
         conn.close()
         
     except sqlite3.Error as e:
         logger.error(f"Error connecting to database: {e}")
-        return
-
-# *** EMAIL FUNCTIONALITY ***
-def check_email_clash(query_parameters: list) -> bool:
-    """ Check if the user has already subscribed to the email service.
-        Only used when user tries to subscribe to the same service multiple times.
-    """ 
-
-    # Set SQL query
-    sql_query = "SELECT * FROM Email WHERE TO_EMAIL = ? AND AGENTS = ? AND DAILY = ? AND WEEKLY = ?"
     
-    # Query database 
-    results = common.connect_to_database(sql_query, query_parameters)
+    metrics.observe_rows("retention.total", summary["rows_deleted"])
+    metrics.observe_bytes("retention.total", summary["bytes_reclaimed"])
     
-    if not results:
-        # No clashing entries found
-        logger.info(f"No clashing entries found for {query_parameters[0]}")
-        return False
-    else:
-        # Clashing entry found
-        logger.info(f"{len(results)} clashing entrie(s) found for {query_parameters[0]}")
-        return True
-
+    return summary
 
+# *** EMAIL FUNCTIONALITY ***
 def email_opt_in(request, agents) -> None:
     """ Check if the user has opted in to receive email subscriptions """
     
@@ -82,39 +152,52 @@ def email_opt_in(request, agents) -> None:
         logger.info("User has opted-in to email subscription")
 
         # Get to_email
-        to_email = [request.form['email-address']]
+        to_email = request.form['email-address']
         
         # Get preferred email recurrence
         if request.form['recurrence'] == "daily":
-            recurrence = [1, 0]
+            daily, weekly = 1, 0
         elif request.form['recurrence'] == "weekly":
-            recurrence = [0, 1]
-        
-        # Convert list of agents into a list containing one continous string of agents separated by a comma
-        agents_string = [",".join(agents)]
+            daily, weekly = 0, 1
         
-        # Combine into single list
-        query_paramaters = to_email + agents_string + recurrence
+        # Get the attachment format (heavy users may prefer Parquet/Arrow to CSV)
+        attachment_format = request.form.get('attachment-format', 'csv')
+        if attachment_format not in common.EXPORT_FORMATS:
+            attachment_format = 'csv'
         
-        logger.info(f"User has requested {request.form['recurrence']} emails to following email address: {to_email}")
-        logger.info(f"Checking database for clashing entries in Email table...")
+        logger.info(f"User has requested {request.form['recurrence']} emails with {attachment_format} attachments to following email address: {to_email}")
         
-        if check_email_clash(query_paramaters):
-            logger.info(f"Clashing entry found for {to_email}.")
-            logger.info("Database will not be updated.")
+        if subscription_upsert(to_email, agents, daily, weekly, attachment_format):
+            logger.info(f"Subscription added (or attachment format changed) for {to_email}.")
         else:
-            logger.info("No clashes found - Updating database")
-        
-            # Set SQL Query
-            sql_query = "INSERT INTO Email (TO_EMAIL, AGENTS, DAILY, WEEKLY) VALUES (?,?,?,?);"
+            logger.info(f"{to_email} is already subscribed to these agents. Database will not be updated.")
 
-            logger.info(f"Updating Email database with following parameters: {query_paramaters}")
-            
-            # Update the database
-            common.connect_to_database(sql_query, query_paramaters, email=True)
+def subscription_upsert(to_email: str, agents: List[str], daily: int, weekly: int, attachment_format: str = 'csv') -> bool:
+    """ Add a subscription in a single transaction. 
+        The unique index on the subscription means an existing subscription (in any agent order) is kept, only its attachment format can change.
+        Returns True if a subscription was created or its attachment format changed.
+    """
+    
+    agent_set_hash = common.agent_set_hash(agents)
+    
+    try:
+        conn = sqlite3.connect(common.DATABASE_NAME)
+        
+        with conn:
+            conn.execute(SQL_UPSERT_SUBSCRIBER, (to_email,))
+            conn.executemany(SQL_UPSERT_SUBSCRIPTION_AGENT, [(agent_set_hash, agent) for agent in set(agents)])
+            cursor = conn.execute(SQL_UPSERT_SUBSCRIPTION, (agent_set_hash, daily, weekly, attachment_format, to_email))
+            created = cursor.rowcount > 0
+        
+        conn.close()
+        return created
+    
+    except sqlite3.Error as e:
+        logger.error(f"Error updating subscriptions: {e}")
+        return False
 
 def check_email_subs(recurrence: str):
-    """ Check the database for email subscribers """
+    """ Check the database for email subscribers, grouped by the set of agents they subscribe to """
     
     logger.info(f"Checking database for {recurrence} email subscriptions.")
     
@@ -140,61 +223,123 @@ def check_email_subs(recurrence: str):
        
         shift_dates = [start_date, end_date]
     
-    # Set SQL query
-    sql_query_email = f"SELECT * FROM Email WHERE {column} = ?"
-    
-    # Pull email info from the databasel
-    email_results = common.connect_to_database(sql_query_email, [int(1)])
+    # Pull the subscribers and the agents for every agent set that's due (one row per subscriber per agent)
+    subscription_results = common.connect_to_database(SQL_SELECT_SUBSCRIPTIONS.format(column=column), [1])
     
-    if email_results:
-        return email_results, shift_dates
-    else:
+    if not subscription_results:
         return None, None
+    
+    # Group the subscribers by agent set, so each set of graphs/CSV is only built once
+    # (dicts keep the first-seen order and drop the repeats the join produces)
+    grouped = {}
+    for agent_set_hash, to_email, attachment_format, agent_name in subscription_results:
+        agent_set = grouped.setdefault(agent_set_hash, {"agents": {}, "formats": {}})
+        agent_set["agents"][agent_name] = None
+        agent_set["formats"][to_email] = attachment_format
+    
+    agent_sets = {
+        agent_set_hash: {"agents": list(agent_set["agents"]), "emails": list(agent_set["formats"]), "formats": agent_set["formats"]}
+        for agent_set_hash, agent_set in grouped.items()
+    }
+    
+    return agent_sets, shift_dates
 
-def email_build_graphs_csvs(row: tuple, shift_dates: list, recurrence: str):
-    """ Function to query database for given subscriber """
-    
-    if row:
-        # Extract the to email address and list of agents
-        to_email_address, agents, = (
-        row[0],
-        row[1].split(',') # Split agent strings by commas and store in list
-        )
-        
-        logger.info(f"Building graphs/CSV for {to_email_address}")
+def email_query_usage(agent_sets: dict, shift_dates: list, recurrence: str) -> List:
+    """ Query the usage for every agent covered by at least one subscription in one go """
+    
+    # Work out the shared agent coverage across all the agent sets
+    agents = sorted({agent for agent_set in agent_sets.values() for agent in agent_set["agents"]})
+    
+    # Build our sql queries and combine the shift day/time range with the agents list to form the query_parameters list
+    if recurrence == "daily":
+        sql_query = common.usage_query(agents, by_shift_day=True)
+        query_parameters = [common.to_shift_day(shift_dates[0])] + agents
+    elif recurrence == "weekly":
+        # Midnight at the start of each date, as the date-only comparison on the old text column did
+        sql_query = common.usage_query(agents)
+        query_parameters = [common.to_epoch(datetime.datetime.combine(shift_date, datetime.time())) for shift_date in shift_dates] + agents
 
-        # Create placeholders list
-        placeholders = ', '.join(['?'] * len(agents))
-        
-        # Combine with agents list to form query_parameters list
-        query_parameters = shift_dates + agents
-        
-        # Build our sql queries
-        if recurrence == "daily":
-            sql_query = f"SELECT * FROM AgentUsage WHERE SHIFT_DATE = ? AND NAME IN ({placeholders})"
-        elif recurrence == "weekly":
-            sql_query = f"SELECT * FROM AgentUsage WHERE ACTUAL_DATE_TIME BETWEEN ? AND ? AND NAME IN ({placeholders})"
-    
-        # Obtain results from database
-        agents_results = common.connect_to_database(sql_query, query_parameters) 
-        
-        if not agents_results:
-            logger.error("No data returned from database.")
-            return
+    # The last shift covered ends at shift_start the day after the last date
+    until_ts = common.to_epoch(datetime.datetime.combine(shift_dates[-1] + datetime.timedelta(days=1), datetime.time(common.shifts_times['shift_start'])))
+    return common.query_reports(sql_query, query_parameters, until_ts) or []
+
+def email_build_graphs_csvs(agent_set_hash: str, agents: List[str], usage_results: List, recurrence: str):
+    """ Build the graphs and CSV for one agent set from the shared usage results """
     
-        # Build our CSV based on the agents_results list
-        csv_file_path, filename, num_of_shifts = common.create_csv(agents_results, email=to_email_address)  
+    logger.info(f"Building graphs/CSV for agent set {agent_set_hash}")
     
-        # Build our graphs from the CSV
-        chart_paths = common.create_graph(csv_file_path, agents, recurrence)
-        logger.info(chart_paths)
-        
-        return to_email_address, chart_paths, csv_file_path, recurrence
-    else:
+    # Only keep the rows for the agents in this set (order is preserved, which create_csv relies on)
+    agents_filter = set(agents)
+    agents_results = [row for row in usage_results if row[0] in agents_filter]
+    
+    if not agents_results:
         logger.error("No data returned from database.")
+        return
+    
+    # Build our CSV based on the agents_results list
+    csv_file_path, filename, num_of_shifts = common.create_csv(agents_results, email=agent_set_hash)  
 
-def send_email(to_email_address, chart_paths, csv_file_path, shift_dates, recurrence):
-    """ Send an email to the specified email address with graphs embedded as images and CSV at attachment """
+    # Build our graphs from the CSV
+    chart_paths = common.create_graph(csv_file_path, agents, recurrence)
+    logger.info(chart_paths)
+    
+    return chart_paths, csv_file_path
+
+def chart_cid(chart_path: str) -> str:
+    """ Generate a Content-ID for a chart, e.g. graph_2025-02-20.png becomes 2025-02-20 """
+    return os.path.basename(chart_path).split('_')[1].removesuffix('.png')
+
+def build_attachment_parts(chart_paths, csv_file_path) -> dict:
+    """ Read and base64-encode a report's charts and attachment into MIME parts.
+        Done once per agent set (and attachment format), then shared by every subscriber's message (see build_messages).
+    """
+    
+    images = {}
+    for chart_path in chart_paths:
+        cid = chart_cid(chart_path)
+        
+        if os.path.exists(chart_path):
+            # Open the image in binary mode (since images are stored as raw binary)
+            # Note img_file is a pointer to the file, not the actual binary data
+            with open(chart_path, 'rb') as img_file:
+                # Load the binary data into memory as a bytes object
+                img_data = img_file.read()
+                # Wrap the binary in an email-friendly format using a MIMEImage object
+                img = MIMEImage(img_data, name=cid)
+                # Add a Content-ID header to the MIMEImage object so the email client can locate the image --> replace the <img> tag with the actual image.
+                # E.g. <img src="cid:20250220"></img> would be replaced with the actual image that has cid:2025-02-20
+                img.add_header('Content-ID', f'<{cid}>')
+                # Tell the email client how to handle the image with a Content-Disposition header. Inline means the client will display the image directly in the email. (as opposed to attachment)
+                img.add_header('Content-Disposition', 'inline', filename=cid)
+                images[chart_path] = img
+    
+    attachment = None
+    if os.path.exists(csv_file_path):
+        
+        # Open csv in binary mode to ensure the file is treated as raw binary data, not text
+        with open(csv_file_path, 'rb') as csv_file:
+            # Load the binary data into memory as a bytes object
+            csv_data = csv_file.read()
+            
+            # MIMEBase is a general-purpose MIME type that can handle arbitrary files. 
+            # Application means general files, octet-stream means the content is binary data.
+            attachment = MIMEBase('application', 'octet-stream')
+            
+            # Set the binary content of the CSV file as the payload (part we want to send) for this MIME part
+            attachment.set_payload(csv_data)
+            
+            # Encode the binary data into text so it can be safely transmitted over email. 
+            encoders.encode_base64(attachment)
+            
+            # Tell the email client to handle the file as an attachment. 
+            attachment.add_header('Content-Disposition', 'attachment', filename=f"{os.path.basename(csv_file_path)}")
+    
+    return {"images": images, "attachment": attachment}
+
+def build_email(to_email_address, chart_paths, csv_file_path, shift_dates, recurrence, parts: dict = None) -> MIMEMultipart:
+    """ Build an email for the specified email address with graphs embedded as images and CSV as attachment.
+        parts are the report's MIME parts from build_attachment_parts, built here if not given.
+    """
     
     # Logging
     logger.info(f"Building email for {to_email_address}")
@@ -221,34 +366,22 @@ def send_email(to_email_address, chart_paths, csv_file_path, shift_dates, recurr
     <p> You are receiving this email because you have signed up for {recurrence} reports from the Robot Usage Tracker. Please see the availablility for the specified agents below: </p>
     """
     
+    # The images and attachment are the same for everyone subscribed to this agent set, so they're usually passed in
+    if parts is None:
+        parts = build_attachment_parts(chart_paths, csv_file_path)
+    
     # Embed the images in the email body using Content-ID (CID)
     # Note CIDs are required by email clients to interpret the embedded images
     for chart_path in chart_paths:
-        # Generate a CID for each image. 
-        # E.g. graph_2025-02-20.png becomes 2025-02-20
-        cid = os.path.basename(chart_path).split('_')[1]
-        cid = cid.removesuffix('.png')
+        cid = chart_cid(chart_path)
         
         # Add the image reference to the HTML body
         body += '<h2><u>' + date_range + '</u></h2>'
         body += f'<img src="cid:{cid}"></img><hr><br>'
         
         # Attach the actual images
-        if os.path.exists(chart_path):
-            # Open the image in binary mode (since images are stored as raw binary)
-            # Note img_file is a pointer to the file, not the actual binary data
-            with open(chart_path, 'rb') as img_file:
-                # Load the binary data into memory as a bytes object
-                img_data = img_file.read()
-                # Wrap the binary in an email-friendly format using a MIMEImage object
-                img = MIMEImage(img_data, name=cid)
-                # Add a Content-ID header to the MIMEImage object so the email client can locate the image --> replace the <img> tag with the actual image.
-                # E.g. <img src="cid:20250220"></img> would be replaced with the actual image that has cid:2025-02-20
-                img.add_header('Content-ID', f'<{cid}>')
-                # Tell the email client how to handle the image with a Content-Disposition header. Inline means the client will display the image directly in the email. (as opposed to attachment)
-                img.add_header('Content-Disposition', 'inline', filename=cid)
-                # Attach the image to the email
-                msg.attach(img)
+        if chart_path in parts["images"]:
+            msg.attach(parts["images"][chart_path])
     
     # Add closing comments to email body. 
     body += """
@@ -263,59 +396,242 @@ def send_email(to_email_address, chart_paths, csv_file_path, shift_dates, recurr
     msg.attach(html_part)
 
     # Add CSV file as attachment
-    if os.path.exists(csv_file_path):
-        
-        # Open csv in binary mode to ensure the file is treated as raw binary data, not text
-        with open(csv_file_path, 'rb') as csv_file:
-            # Load the binary data into memory as a bytes object
-            csv_data = csv_file.read()
-            
-            # MIMEBase is a general-purpose MIME type that can handle arbitrary files. 
-            # Application means general files, octet-stream means the content is binary data.
-            csv_part = MIMEBase('application', 'octet-stream')
-            
-            # Set the binary content of the CSV file as the payload (part we want to send) for this MIME part
-            csv_part.set_payload(csv_data)
-            
-            # Encode the binary data into text so it can be safely transmitted over email. 
-            encoders.encode_base64(csv_part)
-            
-            # Tell the email client to handle the file as an attachment. 
-            csv_part.add_header('Content-Disposition', 'attachment', filename=f"{os.path.basename(csv_file_path)}")
+    if parts["attachment"] is not None:
+        msg.attach(parts["attachment"])
+
+    return msg
+
+def smtp_connect(host: str = None, port: int = None) -> smtplib.SMTP:
+    """ Open an SMTP session, upgrading to TLS and logging in when credentials are configured """
+    
+    smtp = smtplib.SMTP(host or SMTP_SERVER, port or SMTP_PORT, timeout=30)
+    
+    if SMTP_USERNAME and SMTP_PASSWORD:
+        # Only upgrade the connection if the server advertises STARTTLS
+        smtp.ehlo()
+        if smtp.has_extn('starttls'):
+            smtp.starttls()
+            smtp.ehlo()
+        smtp.login(SMTP_USERNAME, SMTP_PASSWORD)
+    
+    return smtp
+
+def send_emails(messages: list, host: str = None, port: int = None):
+    """ Deliver a batch of messages over a single reused SMTP session.
+        Each message is retried on its own, so one failure doesn't abort the rest of the batch.
+        Returns the number of messages sent and a list of the addresses that failed.
+    """
+    
+    smtp = None
+    sent = 0
+    failed = []
+    
+    for msg in messages:
+        to_email_address = msg["To"]
+        delay = SMTP_RETRY_DELAY
         
-            msg.attach(csv_part)
+        for attempt in range(1, SMTP_SEND_ATTEMPTS + 1):
+            try:
+                # (Re)open the session if we don't have one yet or the last attempt dropped it
+                if smtp is None:
+                    smtp = smtp_connect(host, port)
+                
+                logger.info(f"Attempting to send email to {to_email_address} (attempt {attempt})")
+                smtp.send_message(msg)
+                logger.info(f"Email sent to {to_email_address} successfully")
+                sent += 1
+                break
+            except smtplib.SMTPRecipientsRefused as e:
+                # Retrying won't help if the server refuses the address itself
+                logger.error(f"Recipient refused for {to_email_address}: {e}")
+                failed.append(to_email_address)
+                break
+            except (smtplib.SMTPException, OSError) as e:
+                logger.error(f"Error sending email to {to_email_address}: {e}")
+                
+                # Drop the session so the next attempt starts from a fresh connection
+                if smtp is not None:
+                    try:
+                        smtp.close()
+                    except Exception:
+                        pass
+                    smtp = None
+                
+                if attempt == SMTP_SEND_ATTEMPTS:
+                    failed.append(to_email_address)
+                else:
+                    time.sleep(delay)
+                    delay *= 2
+    
+    if smtp is not None:
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+    
+    return sent, failed
 
-    try:
-        with smtplib.SMTP("smtp-server") as smtp:
-            # Logging
-            logger.info(f"Attempting to send email to {to_email_address}")
-            
-            # Send the email
-            smtp.send_message(msg)
-            
-            # Logging
-            logger.info(f"Email sent to {to_email_address} successfully")
-    except Exception as e:
-        logger.error(f"Error sending email: {e}")
+def build_messages(reports: list, shift_dates: list) -> list:
+    """ Assemble one MIME message per (to_email_address, chart_paths, attachment_path, recurrence) report.
+        Reports for the same agent set and attachment format share their charts and file, so their MIME parts are read and
+        encoded once and reused by every subscriber's message (the parts are only read when the messages are sent).
+        Also used by benchmark_email.py.
+    """
+    
+    parts = {}
+    messages = []
+    for to_email_address, chart_paths, attachment_path, recurrence in reports:
+        key = (tuple(chart_paths), attachment_path)
+        if key not in parts:
+            parts[key] = build_attachment_parts(chart_paths, attachment_path)
+        messages.append(build_email(to_email_address, chart_paths, attachment_path, shift_dates, recurrence, parts[key]))
+    
+    return messages
+
+def deliver_emails(messages: list, host: str = None, port: int = None, connections: int = SMTP_CONNECTIONS):
+    """ Split the messages across a small pool of SMTP sessions and send them in parallel """
+    
+    if not messages:
+        return 0, []
+    
+    # Never open more sessions than we have messages to send
+    connections = max(1, min(connections, len(messages)))
+    
+    # Deal the messages out round-robin so each session gets a similar share
+    batches = [messages[i::connections] for i in range(connections)]
+    
+    sent = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        for batch_sent, batch_failed in executor.map(lambda batch: send_emails(batch, host, port), batches):
+            sent += batch_sent
+            failed += batch_failed
+    
+    return sent, failed
         
+@metrics.timed("email.total")
 def email_main(recurrence: str):
     """ Main Function for email functionality """
     
     # Check for any email subscribers
-    email_results, shift_dates = check_email_subs(recurrence)
+    agent_sets, shift_dates = check_email_subs(recurrence)
     
-    if email_results:
+    if agent_sets:
         # Logging
-        logger.info(f"Found {len(email_results)} {recurrence} email subscriptions.")
+        logger.info(f"Found {sum(len(agent_set['emails']) for agent_set in agent_sets.values())} {recurrence} email subscriptions across {len(agent_sets)} agent set(s).")
         
-        # Iterate through the email subscribers
-        for row in email_results:
-            
-            # Build the graphs and CSV for the subscriber
-            to_email_address, chart_paths, csv_file_path, recurrence = email_build_graphs_csvs(row, shift_dates, recurrence)
-
-            # Send email to user(s)
-            send_email(to_email_address, chart_paths, csv_file_path, shift_dates, recurrence)
+        # Pull the usage for every subscribed agent with one query
+        with metrics.time_stage("email.query"):
+            usage_results = email_query_usage(agent_sets, shift_dates, recurrence)
+        metrics.observe_rows("email.query", len(usage_results))
+        
+        # Build the graphs and CSV once per agent set
+        # Note drawing charts is CPU bound, so graphs are still built one agent set at a time
+        reports = []
+        with metrics.time_stage("email.build_graphs_csvs"):
+            for agent_set_hash, agent_set in agent_sets.items():
+                report = email_build_graphs_csvs(agent_set_hash, agent_set["agents"], usage_results, recurrence)
+                if report:
+                    chart_paths, csv_file_path = report
+                    for to_email_address in agent_set["emails"]:
+                        # Converted once per agent set and format, falling back to the CSV if the export isn't possible
+                        attachment_path = common.create_export(csv_file_path, agent_set["formats"].get(to_email_address, "csv")) or csv_file_path
+                        reports.append((to_email_address, chart_paths, attachment_path, recurrence))
+        
+        # Assemble the MIME messages, encoding each agent set's charts and attachment once
+        with metrics.time_stage("email.build_messages"):
+            messages = build_messages(reports, shift_dates)
+        metrics.observe_rows("email.build_messages", len(messages))
+        
+        # Send email to user(s) over a shared pool of SMTP sessions
+        with metrics.time_stage("email.deliver"):
+            sent, failed = deliver_emails(messages)
+        
+        logger.info(f"{sent} {recurrence} email(s) sent.")
+        if failed:
+            logger.error(f"{len(failed)} {recurrence} email(s) could not be sent: {failed}")
     else: 
         # Logging
         logger.info(f"No {recurrence} email subscriptions found.")
+
+# *** REPORT CACHE PRE-WARMING ***
+def preset_ranges(today: datetime.date) -> dict:
+    """Return the date ranges the homepage preset buttons submit (see scripts.js) as {preset: (start, end)}.
+       Only presets that have finished are included. Today and This Week are still being recorded, so a cached copy would be stale.
+    """
+    
+    def preset(start_date, end_date):
+        return datetime.datetime.combine(start_date, PRESET_START_TIME), datetime.datetime.combine(end_date, PRESET_END_TIME)
+    
+    monday = today - datetime.timedelta(days=today.weekday())
+    last_day_of_last_month = today.replace(day=1) - datetime.timedelta(days=1)
+    
+    # First day of the month three months ago
+    year, month = today.year, today.month - 3
+    if month < 1:
+        year, month = year - 1, month + 12
+    
+    return {
+        "yesterday": preset(today - datetime.timedelta(days=1), today),
+        # setLastWeek() submits Monday to Saturday (see check_presets.py)
+        "last_week": preset(monday - datetime.timedelta(days=7), monday - datetime.timedelta(days=2)),
+        "last_month": preset(last_day_of_last_month.replace(day=1), last_day_of_last_month),
+        "last_three_months": preset(datetime.date(year, month, 1), last_day_of_last_month),
+    }
+
+def remove_old_prewarm_runs() -> None:
+    """Delete the files of all but the most recent pre-warm runs"""
+    prewarm_path = os.path.join('static', 'temp', PREWARM_FOLDER)
+    if not os.path.isdir(prewarm_path):
+        return
+    
+    # Run folders are named by date, so they sort oldest first
+    for run in sorted(os.listdir(prewarm_path))[:-PREWARM_RUNS_TO_KEEP]:
+        shutil.rmtree(os.path.join(prewarm_path, run), ignore_errors=True)
+        logger.info(f"Removed old pre-warmed reports from {run}")
+
+@metrics.timed("prewarm.total")
+def prewarm_reports(today: Optional[datetime.date] = None) -> int:
+    """Build and cache the report for each finished preset range for every manager's team and the whole roster,
+       so the first person to click a preset each morning doesn't pay for it. Returns the number of reports cached.
+    """
+    
+    r = common.redis_connect()
+    if not r:
+        logger.error("Redis cache not available, skipping report pre-warming")
+        return 0
+    
+    today = today or datetime.date.today()
+    run_folder = os.path.join(PREWARM_FOLDER, today.isoformat())
+    
+    # Each manager's team plus the whole roster (what the team and "Select All" checkboxes submit)
+    groups = dict(common.teams_hierarchy)
+    groups[common.ORG_LABEL] = [agent for team in common.teams_hierarchy.values() for agent in team]
+    
+    warmed = 0
+    for preset_name, (start_date_time, end_date_time) in preset_ranges(today).items():
+        # One query for the whole roster, split into the groups below
+        agents = groups[common.ORG_LABEL]
+        with metrics.time_stage("prewarm.query"):
+            results = common.query_reports(
+                common.usage_query(agents), [common.to_epoch(start_date_time), common.to_epoch(end_date_time)] + agents, common.to_epoch(end_date_time)
+            ) or []
+        metrics.observe_rows("prewarm.query", len(results))
+        
+        for group_name, group_agents in groups.items():
+            members = set(group_agents)
+            group_results = [row for row in results if row[0] in members]
+            group_hash = common.agent_set_hash(group_agents)
+            
+            with metrics.time_stage("prewarm.build"):
+                csv_file_path, filename, recurrence = common.create_csv(group_results, os.path.join(run_folder, preset_name, group_hash))
+                chart_paths = common.create_graph(csv_file_path, group_agents, recurrence)
+            
+            common.redis_add_report(r, common.report_cache_key(start_date_time, end_date_time, group_agents), csv_file_path, chart_paths, recurrence)
+            logger.info(f"Pre-warmed {preset_name} report for {group_name} ({len(chart_paths)} chart(s))")
+            warmed += 1
+    
+    remove_old_prewarm_runs()
+    
+    logger.info(f"Pre-warmed {warmed} report(s)")
+    return warmed
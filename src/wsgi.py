@@ -0,0 +1,24 @@
+"""Production entry point for the web app.
+
+Run from the src folder as two gunicorn servers behind nginx (see "Running in Production" in the README):
+
+    # Pages, reports and the API: sync workers, one request at a time each
+    gunicorn --workers 4 --bind 127.0.0.1:5000 wsgi:app
+
+    # /live/stream only: one gevent worker holds every open dashboard, each one a greenlet
+    gunicorn --worker-class gevent --workers 1 --worker-connections 2000 --bind 127.0.0.1:5001 wsgi:app
+
+nginx sends /live/stream to the second server and everything else to the first. Never send the stream to the sync
+workers: each viewer would hold a whole worker until gunicorn's 30 second timeout killed it.
+
+The background jobs are not started here, otherwise every worker would run them. Run them once, alongside the web
+servers, with `python scheduler.py`. Without it, none of these happen:
+
+    - the weekly cleanup (archive and delete events past the retention limit)
+    - the daily and weekly report emails
+    - the daily pre-warm of the homepage preset reports, so /filter serves them from the cache
+    - the DuckDB report store sync every 30 minutes, when report_engine is "duckdb" (reports go stale without it)
+"""
+
+# Local application imports
+from app import app